@@ -3,9 +3,20 @@
 # builtin
 import os
 import re
+import sys
 import inspect
 import pickle
 import threading
+import collections
+import time
+import tempfile
+import traceback
+import functools
+import atexit
+import json
+import asyncio
+import contextvars
+import concurrent.futures
 
 # pip
 import emoji
@@ -15,6 +26,9 @@ import flask
 # debug
 from pprint import pprint
 
+# The trace id of the message that is handled in the current thread or task, see ServerHelper.enableTracing()
+currentTrace = contextvars.ContextVar("bothelper_currentTrace", default=None)
+
 
 class VagueReply:
 
@@ -82,15 +96,666 @@ class VagueReply:
         return c
 
 
+class LRUCache:
+    """
+    Thread-safe dict with a maximum size that drops the least recently used
+    entries. Counts hits and misses.
+    """
+
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.__data = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                value = self.__data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxSize:
+                self.__data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            return self.__data.pop(key, default)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.__data),
+            "maxSize": self.maxSize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / total if total else 0.0
+        }
+
+
+class TextRenderer:
+    """
+    Memoizes the text transformations that run on every incoming and outgoing
+    message: emojize, demojize and the character replacements of the bots.
+    Texts longer than maxTextLength are rendered without caching.
+    The button layouts of the bots are cached by their titles and payloads.
+    """
+
+    def __init__(self, maxSize=4096, maxTextLength=1024, maxButtonLayouts=1024):
+        self.maxTextLength = maxTextLength
+        self.emojizeCache = LRUCache(maxSize)
+        self.demojizeCache = LRUCache(maxSize)
+        self.buttonCache = LRUCache(maxButtonLayouts)
+        self.__translationTables = {}
+
+    def emojize(self, text):
+        if ":" not in text:
+            # Nothing to replace
+            return text
+        if len(text) > self.maxTextLength:
+            return emoji.emojize(text, use_aliases=True)
+        result = self.emojizeCache.get(text)
+        if result is None:
+            result = emoji.emojize(text, use_aliases=True)
+            self.emojizeCache.put(text, result)
+        return result
+
+    def demojize(self, text):
+        if text.isascii():
+            # Emojis are never ASCII
+            return text
+        if len(text) > self.maxTextLength:
+            return emoji.demojize(text)
+        result = self.demojizeCache.get(text)
+        if result is None:
+            result = emoji.demojize(text)
+            self.demojizeCache.put(text, result)
+        return result
+
+    def translate(self, text, replacements):
+        """
+        Replace characters in a single pass. :param replacements: is a dict that maps a single character to a string
+        """
+        key = id(replacements)
+        table = self.__translationTables.get(key)
+        if table is None or table[0] is not replacements:
+            table = (replacements, str.maketrans(replacements))
+            self.__translationTables[key] = table
+        return text.translate(table[1])
+
+    def renderButtons(self, platform, buttons, render):
+        """
+        Returns render(buttons). The result is cached for the same :param platform: and the same
+        titles and payloads, so it is shared between messages and must not be modified.
+        """
+        key = (platform, tuple((button[0], button[1] if isinstance(button[1], str) else None) for button in buttons))
+        result = self.buttonCache.get(key)
+        if result is None:
+            result = render(buttons)
+            self.buttonCache.put(key, result)
+        return result
+
+    def stats(self):
+        return {
+            "emojize": self.emojizeCache.stats(),
+            "demojize": self.demojizeCache.stats(),
+            "buttons": self.buttonCache.stats()
+        }
+
+
+class JsonCodec:
+    """
+    Decodes and encodes JSON for webhooks, responses and outbound payloads.
+    :param module: is a module or object with loads() and dumps(). By default orjson
+    is used if it is installed, otherwise the json module.
+    """
+
+    def __init__(self, module=None):
+        if module is None:
+            try:
+                import orjson
+                module = orjson
+            except ImportError:
+                module = json
+        self.module = module
+        self.name = getattr(module, "__name__", type(module).__name__)
+
+    def loads(self, data):
+        """
+        Decodes a bytes or str object. Raises ValueError if it is not valid JSON.
+        """
+        return self.module.loads(data)
+
+    def dumps(self, obj):
+        """
+        Returns a str
+        """
+        try:
+            result = self.module.dumps(obj)
+        except TypeError:
+            # e.g. orjson does not support int keys
+            result = json.dumps(obj)
+        if isinstance(result, bytes):
+            result = result.decode("utf-8")
+        return result
+
+
+class KeyedExecutor:
+    """
+    Runs functions on a bounded thread pool. Functions with the same key run one
+    after another in the order they were submitted, functions with different keys
+    run in parallel.
+    """
+
+    def __init__(self, maxWorkers=None):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=maxWorkers, thread_name_prefix="bothelper")
+        self.__queues = {}
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def submit(self, key, fun, *args, **kwargs):
+        """
+        Returns a concurrent.futures.Future
+        """
+        future = concurrent.futures.Future()
+        item = (future, fun, args, kwargs)
+        with self.__lock:
+            queue = self.__queues.get(key)
+            if queue is None:
+                self.__queues[key] = collections.deque([item])
+            else:
+                queue.append(item)
+        if queue is None:
+            self.pool.submit(self.__drain, key)
+        return future
+
+    def run(self, key, fun, *args, **kwargs):
+        """
+        Submits the function and waits for the result.
+        If this thread is already running a function with the same key, it is called directly.
+        """
+        if getattr(self.__local, "key", None) == key:
+            return fun(*args, **kwargs)
+        return self.submit(key, fun, *args, **kwargs).result()
+
+    def __drain(self, key):
+        self.__local.key = key
+        try:
+            while True:
+                with self.__lock:
+                    future, fun, args, kwargs = self.__queues[key][0]
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fun(*args, **kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+                with self.__lock:
+                    queue = self.__queues[key]
+                    queue.popleft()
+                    if not queue:
+                        del self.__queues[key]
+                        return
+        finally:
+            self.__local.key = None
+
+    def queueDepth(self):
+        with self.__lock:
+            return sum(len(queue) for queue in self.__queues.values())
+
+
+class TokenBucket:
+    """
+    Allows :param rate: operations per second on average and bursts of up to :param burst: operations
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.__tokens = self.burst
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until :param tokens: are available and takes them
+        """
+        while True:
+            wait = self.__take(tokens)
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    async def acquireAsync(self, tokens=1):
+        """
+        Waits in the event loop until :param tokens: are available and takes them
+        """
+        while True:
+            wait = self.__take(tokens)
+            if wait is None:
+                return
+            await asyncio.sleep(wait)
+
+    def __take(self, tokens):
+        """
+        Takes the tokens and returns None, or returns the seconds to wait until they are available
+        """
+        tokens = min(tokens, self.burst)
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            if self.__tokens >= tokens:
+                self.__tokens -= tokens
+                return None
+            return (tokens - self.__tokens) / self.rate
+
+
+class Outbox:
+    """
+    Sends messages on a pool of worker threads, so handlers do not wait for the platform APIs.
+    Messages with the same key are sent in order. The send rate of each platform bot is limited
+    by a TokenBucket with the "sendRate" (per second) and "sendBurst" of its specifications.
+    Pending messages are sent at exit.
+    """
+
+    def __init__(self, maxWorkers=8):
+        self.executor = KeyedExecutor(maxWorkers)
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+        atexit.register(self.flush, 10)
+
+    def bucket(self, bot):
+        """
+        Returns the TokenBucket of the platform bot or None if it has no "sendRate"
+        """
+        key = id(bot)
+        with self.__lock:
+            if key not in self.__buckets:
+                specifications = getattr(bot, "specifications", {})
+                if "sendRate" in specifications:
+                    self.__buckets[key] = TokenBucket(
+                        specifications["sendRate"], specifications.get("sendBurst"))
+                else:
+                    self.__buckets[key] = None
+            return self.__buckets[key]
+
+    def put(self, bot, key, fun, args=(), kwargs=None, tokens=1):
+        """
+        Calls fun(*args, **kwargs) in a worker thread after the previous messages with the same key.
+        Returns a concurrent.futures.Future
+        """
+        bucket = self.bucket(bot) if tokens else None
+        kwargs = kwargs or {}
+
+        def send():
+            if bucket is not None:
+                bucket.acquire(tokens)
+            timingHook = ServerHelper.timingHook
+            if timingHook is None:
+                return fun(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fun(*args, **kwargs)
+            finally:
+                timingHook("bothelper_outbox_send_seconds", (("platform", type(bot).__name__), ("function", getattr(fun, "__name__", "call"))), start, time.perf_counter())
+
+        if ServerHelper.tracer is not None:
+            # The send belongs to the trace of the message that is handled now
+            send = ServerHelper._withTrace(send, ServerHelper._currentTrace())
+
+        future = self.executor.submit((id(bot), key), send)
+        future.add_done_callback(self.__printException)
+        return future
+
+    @staticmethod
+    def __printException(future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            print("Outbox: sending failed:")
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    def queueDepth(self):
+        return self.executor.queueDepth()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all messages are sent. Returns False on timeout.
+        """
+        start = time.monotonic()
+        while self.queueDepth() > 0:
+            if timeout is not None and time.monotonic() - start > timeout:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+class WebhookQueue:
+    """
+    Bounded admission for incoming webhook events. put() hands the events to the KeyedExecutor
+    under the key of their sender and returns immediately, so the events of a user are handled
+    in the order they arrived. At most :param maxSize: events are waiting or running at a time.
+    """
+
+    def __init__(self, executor, maxSize=10000):
+        self.executor = executor
+        self.maxSize = maxSize
+        self.__pending = 0
+        self.__lock = threading.Lock()
+
+    def put(self, events):
+        """
+        :param events: is a list of (key, fun, args). Either all events are accepted or none.
+        Returns False if the queue is full
+        """
+        with self.__lock:
+            if self.__pending + len(events) > self.maxSize:
+                return False
+            self.__pending += len(events)
+        for key, fun, args in events:
+            future = self.executor.submit(key, fun, *args)
+            future.add_done_callback(self.__done)
+        return True
+
+    def __done(self, future):
+        with self.__lock:
+            self.__pending -= 1
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            print("WebhookQueue: handling event failed:")
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    def depth(self):
+        with self.__lock:
+            return self.__pending
+
+
+class CommandIndex:
+    """
+    Compiled lookup structure for the conditions in ServerHelper.commands.
+    Exact textLike keys go into a dict, textStartsWith keys into a prefix trie
+    and textRegexMatch patterns into combined alternations of regexChunkSize
+    patterns each. Every other condition is kept in a list that is evaluated linearly.
+    All conditions are ranked by registration order, so the first matching
+    condition wins just like in a linear scan over the commands.
+    """
+
+    # Patterns with named groups, backreferences or conditional groups cannot be combined safely
+    re_unsafe = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(")
+    # The cost of an alternation grows with the square of the number of groups in it
+    regexChunkSize = 16
+    inlineFlags = (
+        (re.ASCII, "a"),
+        (re.IGNORECASE, "i"),
+        (re.MULTILINE, "m"),
+        (re.DOTALL, "s"),
+        (re.VERBOSE, "x"))
+
+    def __init__(self, commands):
+        self.exact = {}
+        self.trie = {}
+        self.regexChunks = []  # (lowest rank, combined regex, {group number: entry})
+        self.linear = []
+
+        patterns = []
+        rank = 0
+        for commandName in commands:
+            for condition in commands[commandName]["conditions"]:
+                entry = (rank, commandName, condition)
+                kind = getattr(condition, "indexKind", None)
+                key = getattr(condition, "indexKey", None)
+                if kind == "textLike":
+                    if key not in self.exact:
+                        self.exact[key] = entry
+                elif kind == "textStartsWith":
+                    node = self.trie
+                    for char in key:
+                        node = node.setdefault(char, {})
+                    if None not in node:
+                        node[None] = entry
+                elif kind == "textRegexMatch" and not key.groupindex and not self.re_unsafe.search(key.pattern):
+                    flags = "".join(letter for flag, letter in self.inlineFlags if key.flags & flag)
+                    pattern = "((?%s:%s))" % (flags, key.pattern)
+                    try:
+                        groups = re.compile(pattern).groups
+                    except re.error:
+                        self.linear.append(entry)
+                    else:
+                        patterns.append((pattern, groups, entry))
+                else:
+                    self.linear.append(entry)
+                rank += 1
+
+        for i in range(0, len(patterns), self.regexChunkSize):
+            chunk = patterns[i:i + self.regexChunkSize]
+            regexGroups = {}
+            regexGroup = 1
+            for pattern, groups, entry in chunk:
+                # The group number in the combined regex maps to the entry
+                regexGroups[regexGroup] = entry
+                regexGroup += groups
+            self.regexChunks.append((chunk[0][2][0], re.compile("|".join(pattern for pattern, _, _ in chunk)), regexGroups))
+
+    def match(self, msg):
+        """
+        Returns the name of the first command with a matching condition or None
+        """
+        text = msg["text_nice_lower"]
+        best = self.exact.get(text)
+
+        node = self.trie
+        if None in node and (best is None or node[None][0] < best[0]):
+            best = node[None]
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node and (best is None or node[None][0] < best[0]):
+                best = node[None]
+
+        # The chunks are ordered by rank, the first match is the best regex match
+        for firstRank, combinedRegex, regexGroups in self.regexChunks:
+            if best is not None and firstRank > best[0]:
+                break
+            m = combinedRegex.match(msg["text_nice"])
+            if m is not None:
+                entry = regexGroups[m.lastindex]
+                if best is None or entry[0] < best[0]:
+                    best = entry
+                break
+
+        # Conditions that cannot be indexed, in order, up to the best match
+        for entry in self.linear:
+            if best is not None and entry[0] > best[0]:
+                break
+            if entry[2](msg):
+                return entry[1]
+
+        return best[1] if best is not None else None
+
+
 class ServerHelper:
-    def __init__(self):
+    # Shared by all instances, the rendered texts do not depend on the bot
+    renderer = TextRenderer()
+    jsonCodec = JsonCodec()
+    # Called as timingHook(name, labels, start, end, msg=None) after the handlers and sends,
+    # if any timing hook is installed
+    timingHook = None
+    __timingHooks = ()
+    metrics = None
+    tracer = None
+
+    def __init__(self, maxWorkers=None, webhookQueueSize=10000):
+        """
+        Incoming messages are handled on a pool of :param maxWorkers: threads, messages of
+        the same user are handled in order.
+        Platform bots in fast_ack mode hand their webhook events to the same pool without
+        waiting, at most :param webhookQueueSize: events can be pending.
+        """
         self.commands = {}
         self.bot = None
         self.vagueReply = VagueReply()
+        self.executor = KeyedExecutor(maxWorkers)
+        self.__asyncLocks = {}
+        # Set to False to call the platform APIs directly in the handler
+        self.useOutbox = True
+        self.outbox = Outbox()
+        self.webhookQueue = WebhookQueue(self.executor, webhookQueueSize)
+        # Number of messages that are being handled by user id, see _trackHandling()
+        self.__handling = None
+        self.__handlingLock = threading.Lock()
+        # Set to False to match commands with a linear scan over all conditions
+        self.indexCommands = True
+        self.__commandIndex = None
 
     def _registerBot(self, bot):
         self.bot = bot
 
+    @staticmethod
+    def __setTimingHooks(hooks):
+        ServerHelper.__timingHooks = hooks
+        if not hooks:
+            ServerHelper.timingHook = None
+        elif len(hooks) == 1:
+            ServerHelper.timingHook = hooks[0]
+        else:
+            def timingHook(*args):
+                for hook in hooks:
+                    hook(*args)
+            ServerHelper.timingHook = timingHook
+
+    @staticmethod
+    def addTimingHook(hook):
+        """
+        hook(name, labels, start, end, msg=None) is called with the time.perf_counter() values
+        of every measured handler call and send
+        """
+        ServerHelper.__setTimingHooks(ServerHelper.__timingHooks + (hook,))
+
+    @staticmethod
+    def removeTimingHook(hook):
+        ServerHelper.__setTimingHooks(tuple(h for h in ServerHelper.__timingHooks if h != hook))
+
+    def enableMetrics(self):
+        """
+        Starts to record metrics and returns the metrics.Metrics. They are shared by all instances.
+        """
+        if ServerHelper.metrics is None:
+            from .metrics import Metrics
+            ServerHelper.metrics = Metrics()
+            ServerHelper.addTimingHook(ServerHelper.metrics.observeTiming)
+        metrics = ServerHelper.metrics
+        metrics.gauge("bothelper_executor_queue_depth", self.executor.queueDepth)
+        metrics.gauge("bothelper_outbox_queue_depth", self.outbox.queueDepth)
+        metrics.gauge("bothelper_webhook_queue_depth", self.webhookQueueDepth)
+        return metrics
+
+    @staticmethod
+    def disableMetrics():
+        if ServerHelper.metrics is not None:
+            ServerHelper.removeTimingHook(ServerHelper.metrics.observeTiming)
+            ServerHelper.metrics = None
+
+    @staticmethod
+    def enableTracing(sink=None, sampleRate=1.0):
+        """
+        Records timed spans of a :param sampleRate: fraction of the incoming messages: reading the
+        webhook, the adapter, resolving and running the handler, and the sends, including the
+        sends of the outbox. The trace id of a message is in msg["_trace"].
+        :param sink: is a tracing.MemorySink (the default), a tracing.JsonlSink or a file name
+        for a JsonlSink. Returns the tracing.Tracer
+        """
+        from .tracing import Tracer, MemorySink, JsonlSink
+        if sink is None:
+            sink = MemorySink()
+        elif isinstance(sink, str):
+            sink = JsonlSink(sink)
+        ServerHelper.disableTracing()
+        ServerHelper.tracer = Tracer(sink, sampleRate)
+        ServerHelper.addTimingHook(ServerHelper.tracer.observeTiming)
+        return ServerHelper.tracer
+
+    @staticmethod
+    def disableTracing():
+        if ServerHelper.tracer is not None:
+            ServerHelper.removeTimingHook(ServerHelper.tracer.observeTiming)
+            ServerHelper.tracer = None
+
+    @staticmethod
+    def _currentTrace():
+        """
+        Returns the trace id of the current message or webhook request, False if it is not
+        sampled or None if there is none
+        """
+        trace = currentTrace.get()
+        if trace is None and flask.has_request_context():
+            trace = getattr(flask.g, "bothelperTrace", None)
+        return trace
+
+    @staticmethod
+    def _traceMessage(msg):
+        """
+        Returns the trace id of the message and stores it in msg["_trace"]
+        """
+        if "_trace" not in msg:
+            trace = ServerHelper._currentTrace()
+            if trace is None:
+                trace = ServerHelper.tracer.newTrace()
+            msg["_trace"] = trace
+        return msg["_trace"]
+
+    @staticmethod
+    def _withTrace(fun, trace):
+        """
+        Returns a function that calls fun in a copy of the current context, with the trace id set.
+        Use it to carry the trace to another thread.
+        """
+        context = contextvars.copy_context()
+
+        def traced(*args, **kwargs):
+            currentTrace.set(trace)
+            return fun(*args, **kwargs)
+
+        return functools.partial(context.run, traced)
+
+    def __traceIngest(self, fun, args):
+        msg = args[0] if args and isinstance(args[0], dict) else None
+        trace = self._traceMessage(msg) if msg is not None else self._currentTrace()
+        name = getattr(fun, "__name__", "ingest")
+
+        def ingest(*args):
+            timingHook = ServerHelper.timingHook
+            start = time.perf_counter()
+            try:
+                return fun(*args)
+            finally:
+                if timingHook is not None:
+                    timingHook("bothelper_ingest_seconds", (("function", name),), start, time.perf_counter(), msg)
+
+        return self._withTrace(ingest, trace)
+
     def __registerCommand(self, func, condition_wrapper):
         if func.__name__ in self.commands:
             self.commands[func.__name__]["conditions"].append(
@@ -98,51 +763,234 @@ class ServerHelper:
         else:
             self.commands[func.__name__] = {
                 "conditions": [condition_wrapper], "function": func}
+        self.__commandIndex = None
         return func
 
+    def _findCommand(self, msg):
+        """
+        Returns the name of the first command in self.commands whose condition matches msg
+        """
+        if self.indexCommands:
+            if self.__commandIndex is None:
+                self.__commandIndex = CommandIndex(self.commands)
+            return self.__commandIndex.match(msg)
+
+        for commandName in self.commands:
+            for condition in self.commands[commandName]["conditions"]:
+                if condition(msg):
+                    return commandName
+        return None
+
+    def _run(self, userId, fun, *args):
+        """
+        Runs fun(*args) in the executor after the previous messages of this user and waits for the result
+        """
+        if ServerHelper.tracer is not None:
+            fun = self.__traceIngest(fun, args)
+        return self.executor.run(userId, fun, *args)
+
+    def _submit(self, userId, fun, *args):
+        """
+        Runs fun(*args) in the executor after the previous messages of this user, does not wait
+        """
+        if ServerHelper.tracer is not None:
+            fun = self.__traceIngest(fun, args)
+        future = self.executor.submit(userId, fun, *args)
+        future.add_done_callback(self.__printException)
+        return future
+
+    @staticmethod
+    def __printException(future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    @staticmethod
+    def _jsonLoads(data):
+        return ServerHelper.jsonCodec.loads(data)
+
+    @staticmethod
+    def _jsonDumps(obj):
+        return ServerHelper.jsonCodec.dumps(obj)
+
+    @staticmethod
+    def _readWebhook(verify=None):
+        """
+        Reads the body of the current flask request once, verifies it with :param verify: and
+        decodes it. Returns (data, None) or (None, (text, status)) with a response for the webhook.
+        """
+        tracer = ServerHelper.tracer
+        if tracer is None:
+            return ServerHelper.__readWebhook(verify)
+        # The messages of this webhook request belong to one trace
+        trace = flask.g.bothelperTrace = tracer.newTrace()
+        start = time.perf_counter()
+        try:
+            return ServerHelper.__readWebhook(verify)
+        finally:
+            timingHook = ServerHelper.timingHook
+            if timingHook is not None:
+                rule = flask.request.url_rule
+                timingHook("bothelper_webhook_read_seconds", (("route", rule.rule if rule is not None else ""),), start, time.perf_counter(), {"_trace": trace})
+
+    @staticmethod
+    def __readWebhook(verify):
+        body = flask.request.get_data()
+        if verify is not None and not verify(body):
+            return None, ("Signature mismatch", 403)
+        try:
+            data = ServerHelper._jsonLoads(body)
+        except ValueError:
+            return None, ("Corrupt json data", 400)
+        if data is None:
+            return None, ("Corrupt json data", 400)
+        return data, None
+
+    def _ingest(self, events):
+        """
+        Calls fun(*args) for every (userId, fun, args) in :param events: in the executor, after the
+        previous messages of the user, and returns without waiting.
+        Returns False if the queue is full, the webhook should ask the platform to retry later.
+        """
+        if ServerHelper.tracer is not None:
+            events = [(userId, self.__traceIngest(fun, args), args) for userId, fun, args in events]
+        return self.webhookQueue.put(events)
+
+    def webhookQueueDepth(self):
+        """
+        Returns the number of queued webhook events
+        """
+        return self.webhookQueue.depth()
+
+    def _enqueueSend(self, bot, userId, fun, *args, **kwargs):
+        """
+        Calls fun(*args, **kwargs) in the outbox, after the previous messages to this user
+        """
+        if not self.useOutbox:
+            return fun(*args, **kwargs)
+        self.outbox.put(bot, userId, fun, args, kwargs)
+
     @staticmethod
     def _emojize(text):
-        return emoji.emojize(text, use_aliases=True)
+        return ServerHelper.renderer.emojize(text)
 
     @staticmethod
     def _demojize(text):
-        return emoji.demojize(text)
+        return ServerHelper.renderer.demojize(text)
+
+    @staticmethod
+    def _translate(text, replacements):
+        return ServerHelper.renderer.translate(text, replacements)
+
+    @staticmethod
+    def _renderButtons(platform, buttons, render):
+        return ServerHelper.renderer.renderButtons(platform, buttons, render)
+
+    @staticmethod
+    def renderStats():
+        """
+        Returns the hit/miss statistics of the text and button rendering caches
+        """
+        return ServerHelper.renderer.stats()
+
+    re_newline = re.compile(r"\n")
+    re_whitespace = re.compile(r"\s+")
+    re_wordend = re.compile(r"\b\s*")
+
+    @staticmethod
+    def splitText(text, maxLength):
+        """
+        Generator that splits a long text into chunks of at most :param maxLength: characters.
+        A chunk ends preferably at the last newline, otherwise at the last whitespace, otherwise
+        at the last end of a word, within the last 50 characters of the chunk. If there is none of these, the
+        text is cut and the cut is marked with an ellipsis.
+        The text is scanned once, so this takes linear time in the length of the text.
+        :param maxLength: has to be at least 7, so a cut chunk holds a character between the ellipses.
+        """
+        if maxLength < 7:
+            raise ValueError("maxLength has to be at least 7, got %r" % (maxLength,))
+        N = maxLength
+        end = len(text)
+        pos = 0
+        prefix = ""
+
+        if end > N:
+            # Skip leading whitespace like after each split, so the first chunk is not blank
+            while pos < end and text[pos].isspace():
+                pos += 1
+
+        while len(prefix) + end - pos > N:
+            limit = pos + N - len(prefix)  # Chunk may end before this index
+            start = max(pos + 1, limit - 50)
+            # One character more on each side, so word boundaries are recognized
+            window = text[start - 1:limit + 1]
+
+            m = None
+            for regex in (
+                    ServerHelper.re_newline,
+                    ServerHelper.re_whitespace,
+                    ServerHelper.re_wordend):
+                # Take the last match, to keep the chunk as long as possible
+                for candidate in regex.finditer(window, 1):
+                    if start - 1 + candidate.start() > limit:
+                        break
+                    m = candidate
+                if m is not None:
+                    break
+
+            if m is None:
+                # Split anywhere
+                cut = limit - 3
+                yield prefix + text[pos:cut] + "..."
+                prefix = "..."
+                pos = cut
+            else:
+                # Split at match
+                yield prefix + text[pos:start - 1 + m.start()]
+                prefix = ""
+                pos = start - 1 + m.end()
+
+            while pos < end and text[pos].isspace():
+                pos += 1
+
+        if pos == 0:
+            yield text
+        else:
+            rest = prefix + text[pos:].rstrip()
+            if rest:
+                yield rest
+
+    @staticmethod
+    def __timed(name, method, msg, fun, *args):
+        timingHook = ServerHelper.timingHook
+        if timingHook is None:
+            return fun(*args)
+        start = time.perf_counter()
+        try:
+            return fun(*args)
+        finally:
+            timingHook(name, (("platform", type(msg["_bot"]).__name__), ("method", method)), start, time.perf_counter(), msg)
 
     @staticmethod
     def _sendText(msg, text, buttons=None, is_question=False):
+        if ServerHelper.timingHook is not None:
+            return ServerHelper.__timed("bothelper_send_seconds", "sendText", msg, ServerHelper.__sendText, msg, text, buttons, is_question)
+        return ServerHelper.__sendText(msg, text, buttons, is_question)
+
+    @staticmethod
+    def __sendText(msg, text, buttons=None, is_question=False):
         # Check length of message
         if "maxMessageLength" in msg["_bot"].specifications and len(
                 text) > msg["_bot"].specifications["maxMessageLength"]:
-            N = msg["_bot"].specifications["maxMessageLength"]
-
-            re_newline = re.compile(r"\n|$", flags=re.MULTILINE)
-            re_whitespace = re.compile(r"\s+", flags=re.MULTILINE)
-            re_wordend = re.compile(r"\b\s*", flags=re.MULTILINE)
-
-            # Split long message up
-            while len(text) > N:
-                # Try to split at newline
-                m = re_newline.search(text, pos=N - 50)
-                if not m:  # try to split at whitespace
-                    m = re_whitespace.search(text, pos=N - 50)
-                    if not m:  # try to split at wordend
-                        m = re_wordend.search(text, pos=N - 50)
-
-                if not m or m.end() == len(text):
-                    # split anywhere
-                    text, rest = text[0:N - 5] + \
-                        "...", "..." + text[N - 5:].strip()
-                else:
-                    # split at match
-                    text, rest = text[0:m.start()], text[m.end():].strip()
-
-                if len(rest) == 0:
-                    text = rest
-                    break
-                else:
-                    msg["_bot"].sendText(msg, text)
-
-                text = rest
+            # Split long message up, the last chunk is sent with the buttons
+            chunks = ServerHelper.splitText(
+                text, msg["_bot"].specifications["maxMessageLength"])
+            text = next(chunks)
+            for chunk in chunks:
+                msg["_bot"].sendText(msg, text)
+                text = chunk
 
         if is_question and getattr(
             msg["_bot"],
@@ -154,13 +1002,20 @@ class ServerHelper:
 
     @staticmethod
     def _sendLink(msg, url, buttons=None, text=""):
+        if ServerHelper.timingHook is not None:
+            return ServerHelper.__timed("bothelper_send_seconds", "sendLink", msg, msg["_bot"].sendLink, msg, url, buttons, text)
         return msg["_bot"].sendLink(msg, url, buttons, text)
 
     @staticmethod
     def _sendPhoto(msg, url, buttons=None):
+        if ServerHelper.timingHook is not None:
+            return ServerHelper.__timed("bothelper_send_seconds", "sendPhoto", msg, msg["_bot"].sendPhoto, msg, url, buttons)
         return msg["_bot"].sendPhoto(msg, url, buttons)
 
-    def _handleTextMessage(self, msg):
+    def _resolveTextMessage(self, msg):
+        """
+        Returns the handler of a text message as a tuple (function, args) or None
+        """
         user = self.bot.user(msg)
 
         msg["text_nice"] = self._demojize(msg["text"].strip())
@@ -170,64 +1025,215 @@ class ServerHelper:
         m = user.getResponse(msg["text_nice_lower"])
         if m is not None:
             function = m[0]
-            function(msg)
-            return True
+            return function, (msg,)
 
         # Fallback to question onOtherResponse
         onOtherResponse = user.getOnOtherResponse()
         if onOtherResponse is not None:
             function, lastStage = onOtherResponse[1]
             if len(inspect.signature(function).parameters) == 2:
-                function(msg, lastStage)
+                return function, (msg, lastStage)
             else:
-                function(msg)
-            return True
+                return function, (msg,)
 
         # Match any other
-        for commandName in self.commands:
-            for condition in self.commands[commandName]["conditions"]:
-                if condition(msg):
-                    self.commands[commandName]["function"](self.bot, msg)
-                    return True
+        commandName = self._findCommand(msg)
+        if commandName is not None:
+            return self.commands[commandName]["function"], (self.bot, msg)
 
         # Fallback to generic onOther
         if hasattr(self.bot, 'onOtherResponse'):
-            self.bot.onOtherResponse(msg)
-            return True
+            return self.bot.onOtherResponse, (msg,)
 
         print("No handler found for text message: %s" %
               msg["text_nice"].encode('unicode-escape').decode('ascii'))
-        return False
+        return None
 
-    def _handleFriendPicker(self, msg):
+    def _resolveFriendPicker(self, msg):
         if hasattr(self.bot, 'onFriendPicker'):
-            self.bot.onFriendPicker(msg)
-            return True
-        return False
+            return self.bot.onFriendPicker, (msg,)
+        return None
 
-    def _handleLocation(self, msg):
+    def _resolveLocation(self, msg):
         if hasattr(self.bot, 'onLocation'):
-            self.bot.onLocation(msg)
-            return True
-        return False
+            return self.bot.onLocation, (msg,)
+        return None
 
-    def _handleButtonClick(self, msg):
+    def _resolveButtonClick(self, msg):
         user = self.bot.user(msg)
         button = user.getButton(msg["text"])
         if button is None:
-            return self._handleTextMessage(msg)
+            return self._resolveTextMessage(msg)
         if isinstance(button[1], str):
             msg["text"] = button[1]
             msg["text_nice"] = self._demojize(msg["text"].strip())
             msg["text_nice_lower"] = msg["text_nice"].lower()
-            return self._handleTextMessage(msg)
+            return self._resolveTextMessage(msg)
         else:
             msg["text_nice"] = self._demojize(msg["text"].strip())
             msg["text_nice_lower"] = msg["text_nice"].lower()
-            function = button[1]
-            function(msg)
+            return button[1], (msg,)
+
+    @staticmethod
+    def __callHandler(handler, msg):
+        if handler is None:
+            if ServerHelper.metrics is not None:
+                ServerHelper.metrics.inc("bothelper_unhandled_messages_total")
+            return False
+        function, args = handler
+        timingHook = ServerHelper.timingHook
+        if timingHook is not None:
+            start = time.perf_counter()
+        try:
+            result = function(*args)
+            if inspect.isawaitable(result):
+                # An async handler outside of an event loop
+                asyncio.run(result)
+        finally:
+            if timingHook is not None:
+                timingHook("bothelper_handler_seconds", (("command", getattr(function, "__name__", "handler")),), start, time.perf_counter(), msg)
         return True
 
+    def _trackHandling(self):
+        """
+        Counts the messages that are being handled per user, so _isHandling() can be used
+        """
+        if self.__handling is None:
+            self.__handling = collections.Counter()
+
+    def _isHandling(self, userId):
+        handling = self.__handling
+        return handling is not None and handling[userId] > 0
+
+    def __countHandling(self, userId, n):
+        with self.__handlingLock:
+            self.__handling[userId] += n
+            if self.__handling[userId] <= 0:
+                del self.__handling[userId]
+
+    def __dispatch(self, kind, resolve, msg):
+        if self.__handling is not None:
+            userId = msg.get("_userId")
+            self.__countHandling(userId, 1)
+            try:
+                return self.__dispatchTimed(kind, resolve, msg)
+            finally:
+                self.__countHandling(userId, -1)
+        return self.__dispatchTimed(kind, resolve, msg)
+
+    def __dispatchTimed(self, kind, resolve, msg):
+        timingHook = ServerHelper.timingHook
+        if timingHook is None:
+            return self.__callHandler(resolve(msg), msg)
+        if ServerHelper.tracer is not None:
+            self._traceMessage(msg)
+        labels = (("type", kind),)
+        start = time.perf_counter()
+        try:
+            handler = resolve(msg)
+            timingHook("bothelper_resolve_seconds", labels, start, time.perf_counter(), msg)
+            return self.__callHandler(handler, msg)
+        finally:
+            timingHook("bothelper_dispatch_seconds", labels, start, time.perf_counter(), msg)
+
+    def _handleTextMessage(self, msg):
+        return self.__dispatch("text", self._resolveTextMessage, msg)
+
+    def _handleFriendPicker(self, msg):
+        return self.__dispatch("friendPicker", self._resolveFriendPicker, msg)
+
+    def _handleLocation(self, msg):
+        return self.__dispatch("location", self._resolveLocation, msg)
+
+    def _handleButtonClick(self, msg):
+        return self.__dispatch("buttonClick", self._resolveButtonClick, msg)
+
+    async def __handleAsync(self, kind, resolve, msg):
+        """
+        Handles a message in the running event loop. Handlers defined with async def are
+        awaited, other handlers run in the thread pool of the executor.
+        Messages of the same user are handled in order.
+        """
+        if self.__handling is not None:
+            userId = msg.get("_userId")
+            self.__countHandling(userId, 1)
+            try:
+                return await self.__handleAsyncTraced(kind, resolve, msg)
+            finally:
+                self.__countHandling(userId, -1)
+        return await self.__handleAsyncTraced(kind, resolve, msg)
+
+    async def __handleAsyncTraced(self, kind, resolve, msg):
+        if ServerHelper.tracer is not None:
+            token = currentTrace.set(self._traceMessage(msg))
+            try:
+                return await self.__handleAsyncTimed(kind, resolve, msg)
+            finally:
+                currentTrace.reset(token)
+        return await self.__handleAsyncTimed(kind, resolve, msg)
+
+    async def __handleAsyncTimed(self, kind, resolve, msg):
+        timingHook = ServerHelper.timingHook
+        if timingHook is None:
+            return await self.__handleAsyncLocked(resolve, msg)
+        labels = (("type", kind),)
+        start = time.perf_counter()
+        try:
+            return await self.__handleAsyncLocked(resolve, msg, labels, start)
+        finally:
+            timingHook("bothelper_dispatch_seconds", labels, start, time.perf_counter(), msg)
+
+    async def __handleAsyncLocked(self, resolve, msg, labels=None, start=None):
+        loop = asyncio.get_running_loop()
+        key = (id(loop), msg["_userId"])
+        if key not in self.__asyncLocks:
+            self.__asyncLocks[key] = [asyncio.Lock(), 0]
+        lock = self.__asyncLocks[key]
+        lock[1] += 1
+        try:
+            async with lock[0]:
+                handler = resolve(msg)
+                timingHook = ServerHelper.timingHook
+                if timingHook is not None and labels is not None:
+                    timingHook("bothelper_resolve_seconds", labels, start, time.perf_counter(), msg)
+                if handler is None:
+                    if ServerHelper.metrics is not None:
+                        ServerHelper.metrics.inc("bothelper_unhandled_messages_total")
+                    return False
+                function, args = handler
+                if timingHook is not None:
+                    start = time.perf_counter()
+                try:
+                    if inspect.iscoroutinefunction(function):
+                        result = function(*args)
+                    else:
+                        call = functools.partial(function, *args)
+                        if ServerHelper.tracer is not None:
+                            call = self._withTrace(call, msg.get("_trace"))
+                        result = await loop.run_in_executor(self.executor.pool, call)
+                    if inspect.isawaitable(result):
+                        await result
+                finally:
+                    if timingHook is not None:
+                        timingHook("bothelper_handler_seconds", (("command", getattr(function, "__name__", "handler")),), start, time.perf_counter(), msg)
+                return True
+        finally:
+            lock[1] -= 1
+            if lock[1] == 0:
+                del self.__asyncLocks[key]
+
+    async def _handleTextMessageAsync(self, msg):
+        return await self.__handleAsync("text", self._resolveTextMessage, msg)
+
+    async def _handleFriendPickerAsync(self, msg):
+        return await self.__handleAsync("friendPicker", self._resolveFriendPicker, msg)
+
+    async def _handleLocationAsync(self, msg):
+        return await self.__handleAsync("location", self._resolveLocation, msg)
+
+    async def _handleButtonClickAsync(self, msg):
+        return await self.__handleAsync("buttonClick", self._resolveButtonClick, msg)
+
     def all(self, *args):
         def wrapper(func):
             org_func_name = func.__name__
@@ -236,6 +1242,7 @@ class ServerHelper:
                 arg(func)
             conditions = self.commands.pop(func.__name__)["conditions"]
             func.__name__ = org_func_name
+            self.__commandIndex = None
 
             def __condition(self, msg):
                 return all([condition(msg) for condition in conditions])
@@ -247,24 +1254,34 @@ class ServerHelper:
         return wrapper
 
     def textLike(self, text):
+        key = text.strip().lower()
+
         def __condition(self, msg):
-            return text.strip().lower() == msg["text_nice_lower"]
+            return key == msg["text_nice_lower"]
 
         def condition_wrapper(msg):
             return __condition(self, msg)
 
+        condition_wrapper.indexKind = "textLike"
+        condition_wrapper.indexKey = key
+
         def register_command(func):
             return self.__registerCommand(func, condition_wrapper)
 
         return register_command
 
     def textStartsWith(self, text):
+        key = text.strip().lower()
+
         def __condition(self, msg):
-            return msg["text_nice_lower"].startswith(text.strip().lower())
+            return msg["text_nice_lower"].startswith(key)
 
         def condition_wrapper(msg):
             return __condition(self, msg)
 
+        condition_wrapper.indexKind = "textStartsWith"
+        condition_wrapper.indexKey = key
+
         def register_command(func):
             return self.__registerCommand(func, condition_wrapper)
 
@@ -279,6 +1296,9 @@ class ServerHelper:
         def condition_wrapper(msg):
             return __condition(self, msg)
 
+        condition_wrapper.indexKind = "textRegexMatch"
+        condition_wrapper.indexKey = regex_pattern
+
         def register_command(func):
             return self.__registerCommand(func, condition_wrapper)
 
@@ -298,7 +1318,13 @@ class ServerHelper:
 
 
 class Bot:
-    def __init__(self, serverHelper, title="Bot", userFile=None):
+    def __init__(self, serverHelper, title="Bot", userFile=None, userStore=None):
+        """
+        Users are kept in self.users. If :param userStore: is given (e.g. a
+        userstore.SQLiteUserStore), users are loaded from it on demand and saveUserFile()
+        writes the changed users to it. An existing :param userFile: is imported into the
+        userStore once.
+        """
         self.serv = serverHelper
         self.serv._registerBot(self)
         self.title = title
@@ -312,15 +1338,38 @@ class Bot:
         self.users = {}
         self.userFile = userFile
         self.userStorage = None
+        self.userStore = userStore
+        self.__changedUsers = set()
+        self.__usersLock = threading.RLock()
+        self.__eviction = None
 
-        if self.userFile is not None and os.path.isfile(self.userFile):
+        if self.userStore is not None:
+            self.userStore.attach(self)
+            imported = self.userStore.importPickle(self.userFile)
+            if imported:
+                self.users = imported
+
+        elif self.userFile is not None and os.path.isfile(self.userFile):
 
             with open(self.userFile, "rb") as fs:
 
                 self.users = pickle.load(fs)
 
-    def addPermanentStorage(self, storage):
-        self.userStorage = storage
+    def addPermanentStorage(self, storage, writeBehind=True, **kwargs):
+        """
+        :param storage: is an object with the methods store(bot, userId, key, value),
+        retrieve(bot, userId) and clear(bot, userId).
+        If :param writeBehind: is True, writes are batched by a userstore.WriteBehindStorage,
+        the remaining arguments are passed to it.
+        """
+        if writeBehind:
+            from .userstore import WriteBehindStorage
+            storage = WriteBehindStorage(storage, **kwargs)
+        with self.__usersLock:
+            self.userStorage = storage
+            # The storage is not pickled with the users
+            for user in self.users.values():
+                user.storage = storage
 
     def getPermanentStorage(self):
         return self.userStorage
@@ -336,6 +1385,36 @@ class Bot:
 
         return self.__flaskServer
 
+    def enableMetrics(self, route="/metrics"):
+        """
+        Records handler, send and request latencies, the number of users and the queue depths.
+        The metrics are served in the Prometheus text format at :param route: of the Flask app,
+        if route is not None. Returns the metrics.Metrics
+        With a route, call this before run(): Flask does not accept new routes and hooks once the
+        app has served a request, a RuntimeError is raised then. Later calls are no-ops.
+        """
+        if route is not None:
+            app = self.getFlask()
+            endpoint = "%s.%s@%s" % (self, "metrics", route)  # Unique endpoint name
+            registered = endpoint in app.view_functions and "bothelper.metrics" in app.extensions
+            if not registered and getattr(app, "_got_first_request", False):
+                raise RuntimeError("Bot.enableMetrics(route=%r) has to be called before the Flask app serves requests" % route)
+
+        metrics = self.serv.enableMetrics()
+        metrics.gauge("bothelper_users", lambda: len(self.users), (("bot", self.title),))
+        if route is not None:
+            if endpoint not in app.view_functions:
+                app.route(route, methods=["GET"], endpoint=endpoint)(self.__metricsRoute)
+            metrics.instrumentFlask(app)
+        return metrics
+
+    @staticmethod
+    def __metricsRoute():
+        metrics = ServerHelper.metrics
+        if metrics is None:
+            return "Metrics are disabled", 404
+        return metrics.render(), 200, {"Content-Type": metrics.contentType}
+
     def __runFlask(self, host, port):
         return self.__flaskServer.run(
             port=port, host=host, debug=False, threaded=True)
@@ -369,17 +1448,205 @@ class Bot:
 
         return self.__flaskServer
 
+    def setUserEviction(self, idleTime=None, maxUsers=None, store=None, maxWork=32):
+        """
+        Moves users from self.users to disk if they have been idle for :param idleTime: seconds
+        or if there are more than :param maxUsers: users in memory, least recently active first.
+        Evicted users are loaded again on their next message by user(msg).
+        Users are written to :param store:, the userStore or otherwise to a temporary
+        userstore.SQLiteUserStore. Users that cannot be pickled stay in memory and do not count
+        towards maxUsers, they are tried again after their next message. Users whose messages
+        are being handled are not evicted.
+        The users are written by a background thread, so the messages do not wait for the disk.
+        It looks at up to :param maxWork: users at a time.
+        """
+        self.__stopEviction()
+        if idleTime is None and maxUsers is None:
+            return
+
+        with self.__usersLock:
+            path = None
+            if store is None:
+                store = self.userStore
+            if store is None:
+                from .userstore import SQLiteUserStore
+                fd, path = tempfile.mkstemp(prefix="bothelper_users_", suffix=".sqlite")
+                os.close(fd)
+                store = SQLiteUserStore(path)
+                atexit.register(self.__stopEviction, False)
+            store.attach(self)
+            self.serv._trackHandling()
+
+            self.users = collections.OrderedDict(self.users)
+            now = time.monotonic()
+            self.__eviction = {
+                "idleTime": idleTime,
+                "maxUsers": maxUsers,
+                "maxWork": maxWork,
+                "store": store,
+                "path": path,  # Temporary file that is removed again
+                "lastSeen": {userId: now for userId in self.users},
+                "unpicklable": {},  # userId -> True if the user changed since pickling failed
+                "wake": threading.Event(),
+                "stop": False,
+                "skipped": 0  # Users skipped since the last candidate
+            }
+            thread = threading.Thread(
+                target=self.__sweepUsers, args=(self.__eviction,), name="bothelper-eviction", daemon=True)
+            self.__eviction["thread"] = thread
+            thread.start()
+
+    def __stopEviction(self, loadUsers=True):
+        """
+        Stops the eviction thread, loads the evicted users back into memory and removes the
+        temporary store
+        """
+        with self.__usersLock:
+            eviction, self.__eviction = self.__eviction, None
+        if eviction is None:
+            return
+        eviction["stop"] = True
+        eviction["wake"].set()
+        if eviction["thread"] is not threading.current_thread():
+            eviction["thread"].join()
+
+        with self.__usersLock:
+            store = eviction["store"]
+            if loadUsers and store is not self.userStore:
+                for userId, user in store.loadAll().items():
+                    if userId not in self.users:
+                        user.storage = self.userStorage
+                        self.users[userId] = user
+            if eviction["path"] is not None:
+                store.close()
+                for suffix in ("", "-wal", "-shm"):
+                    try:
+                        os.remove(eviction["path"] + suffix)
+                    except OSError:
+                        pass
+
+    def __sweepUsers(self, eviction):
+        """
+        Eviction thread, runs every second or when user() finds too many users in memory
+        """
+        while not eviction["stop"]:
+            eviction["wake"].wait(1)
+            eviction["wake"].clear()
+            eviction["skipped"] = 0
+            try:
+                while not eviction["stop"] and self.__evictUsers(eviction):
+                    pass
+            except Exception:
+                print("Bot: evicting users failed:")
+                traceback.print_exc()
+
+    def __evictUsers(self, eviction):
+        """
+        Writes up to maxWork users to the store and removes them from memory.
+        The users are picked and removed with the lock held, but pickled and written without it.
+        Returns True if there may be more users to evict.
+        """
+        idleTime = eviction["idleTime"]
+        maxUsers = eviction["maxUsers"]
+        lastSeen = eviction["lastSeen"]
+        unpicklable = eviction["unpicklable"]
+        candidates = []
+        more = False
+        with self.__usersLock:
+            if self.__eviction is not eviction:
+                return False
+            now = time.monotonic()
+            for _ in range(min(eviction["maxWork"], len(self.users))):
+                userId = next(iter(self.users))
+                tooMany = maxUsers is not None and len(self.users) - len(unpicklable) - len(candidates) > maxUsers
+                tooOld = idleTime is not None and now - lastSeen.get(userId, now) > idleTime
+                if not tooMany and not tooOld:
+                    break
+                self.users.move_to_end(userId)
+                if unpicklable.get(userId) is not False and not self.serv._isHandling(userId):
+                    candidates.append((userId, self.users[userId], lastSeen.get(userId)))
+                    eviction["skipped"] = 0
+                else:
+                    # Skip without trying to pickle it again
+                    eviction["skipped"] += 1
+            else:
+                # Stop after one round through all users without any candidate, e.g. if
+                # all of them are being handled
+                more = eviction["skipped"] < len(self.users)
+
+        for userId, user, seen in candidates:
+            spilled = eviction["store"].spill(user)
+            with self.__usersLock:
+                if self.__eviction is not eviction:
+                    return False
+                if self.users.get(userId) is not user:
+                    # Removed in the meantime
+                    if spilled:
+                        eviction["store"].delete(userId)
+                elif lastSeen.get(userId) != seen or self.serv._isHandling(userId):
+                    # Active again, the user stays in memory. The stored copy is replaced when
+                    # it is evicted the next time.
+                    pass
+                elif spilled:
+                    del self.users[userId]
+                    lastSeen.pop(userId, None)
+                    unpicklable.pop(userId, None)
+                    self.__changedUsers.discard(userId)
+                else:
+                    unpicklable[userId] = False
+
+        return more
+
     def user(self, msg):
         userId = msg["_userId"]
-        if userId not in self.users:
-            self.users[userId] = User(
-                userId=userId,
-                lastMsg=msg,
-                storage=self.userStorage,
-                bot=msg["_bot"])
-
-        self.users[userId].msg(msg)
-        return self.users[userId]
+        with self.__usersLock:
+            user = self.users.get(userId)
+            if user is None:
+                if self.__eviction is not None:
+                    user = self.__eviction["store"].load(userId)
+                if user is None and self.userStore is not None and (
+                        self.__eviction is None or self.__eviction["store"] is not self.userStore):
+                    user = self.userStore.load(userId)
+                if user is None:
+                    user = User(
+                        userId=userId,
+                        lastMsg=msg,
+                        storage=self.userStorage,
+                        bot=msg["_bot"])
+                else:
+                    user.storage = self.userStorage
+                self.users[userId] = user
+
+            self.__changedUsers.add(userId)
+            if self.__eviction is not None:
+                if userId in self.__eviction["unpicklable"]:
+                    # The user changes now, try to pickle it again
+                    self.__eviction["unpicklable"][userId] = True
+                self.users.move_to_end(userId)
+                self.__eviction["lastSeen"][userId] = time.monotonic()
+                maxUsers = self.__eviction["maxUsers"]
+                if maxUsers is not None and len(self.users) - len(self.__eviction["unpicklable"]) > maxUsers:
+                    self.__eviction["wake"].set()
+
+        user.msg(msg)
+        return user
+
+    def removeUser(self, userId):
+        """
+        Forgets the user, in memory and in the user stores. Used for users that cannot return,
+        e.g. an expired HtmlBot session.
+        """
+        with self.__usersLock:
+            self.users.pop(userId, None)
+            self.__changedUsers.discard(userId)
+            eviction = self.__eviction
+            if eviction is not None:
+                eviction["lastSeen"].pop(userId, None)
+                eviction["unpicklable"].pop(userId, None)
+                if eviction["store"] is not self.userStore:
+                    eviction["store"].delete(userId)
+            if self.userStore is not None:
+                self.userStore.delete(userId)
 
     def startConversation(self, msg, forceExitCommand="/cancel"):
         user = self.user(msg)
@@ -462,9 +1729,18 @@ class Bot:
         return self.serv._sendText(msg, text, buttons=buttons)
 
     def saveUserFile(self):
+        if self.userStore is not None:
+            changed, self.__changedUsers = self.__changedUsers, set()
+            return self.userStore.save(
+                self.users[userId] for userId in changed if userId in self.users)
         if self.userFile is not None:
+            users = self.users
+            if self.__eviction is not None:
+                # Include the evicted users
+                users = self.__eviction["store"].loadAll()
+                users.update(self.users)
             with open(self.userFile, "wb") as fs:
-                pickle.dump(self.users, fs)
+                pickle.dump(users, fs)
 
     @staticmethod
     def runInThread(fun, *args, **kwargs):
@@ -488,17 +1764,76 @@ class Bot:
 
 
 class User:
+    __slots__ = (
+        "__lastMsg",
+        "userId",
+        "bot",
+        "storage",
+        "_data",
+        "_userdata",
+        "conversation")
+
+    onOtherResponseNAME = "__onOtherResponse__123"
+
     def __init__(self, userId, lastMsg=None, storage=None, bot=None):
         self.__lastMsg = lastMsg
-        self.userId = userId
+        self.userId = sys.intern(userId) if isinstance(userId, str) else userId
         self.bot = bot
         self.storage = storage
-        self.data = {}
-        self.userdata = {}
+        # The dicts are created on first use
+        self._data = None
+        self._userdata = None
         if self.storage is not None:
-            self.userdata = self.storage.retrieve(self.bot, userId)
+            self._userdata = self.storage.retrieve(self.bot, userId) or None
         self.conversation = None
-        self.onOtherResponseNAME = "__onOtherResponse__123"
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {}
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def userdata(self):
+        if self._userdata is None:
+            self._userdata = {}
+        return self._userdata
+
+    @userdata.setter
+    def userdata(self, value):
+        self._userdata = value
+
+    def __getstate__(self):
+        return {
+            "_User__lastMsg": self.__lastMsg,
+            "userId": self.userId,
+            "bot": self.bot,
+            "data": self._data,
+            "userdata": self._userdata,
+            "conversation": self.conversation
+        }
+
+    def __setstate__(self, state):
+        # Also accepts the __dict__ of users pickled before __slots__ were used.
+        # The storage is attached again by the Bot
+        self.__lastMsg = state.get("_User__lastMsg")
+        self.userId = state["userId"]
+        if isinstance(self.userId, str):
+            self.userId = sys.intern(self.userId)
+        self.bot = state.get("bot")
+        self.storage = state.get("storage")
+        self._data = state.get("data") or None
+        self._userdata = state.get("userdata") or None
+        self.conversation = state.get("conversation")
+
+    def __root(self):
+        if self.conversation is not None:
+            return self.conversation
+        return self._data if self._data is not None else {}
 
     def msg(self, msg=None):
         if msg is None:
@@ -513,8 +1848,7 @@ class User:
         self.conversation = None
 
     def __clearResponses(self):
-        root = self.data if self.conversation is None else self.conversation
-        root["buttons"] = {}
+        self.__root().pop("buttons", None)
 
     def clearResponses(self):
         self.__clearResponses()
@@ -525,13 +1859,13 @@ class User:
             self.storage.store(self.bot, self.userId, key, value)
 
     def retrieveValue(self, key, default=None):
-        if key in self.userdata:
-            return self.userdata[key]
+        if self._userdata is not None and key in self._userdata:
+            return self._userdata[key]
         else:
             return default
 
     def clearValues(self):
-        self.userdata = {}
+        self._userdata = None
         if self.storage is not None:
             self.storage.clear(self.bot, self.userId)
 
@@ -564,7 +1898,7 @@ class User:
                 onOtherResponse, onOtherResponseReturn)
 
     def getButton(self, key, clear=True):
-        root = self.data if self.conversation is None else self.conversation
+        root = self.__root()
 
         if "buttons" not in root:
             return None
@@ -591,7 +1925,7 @@ class User:
         return self.getButton(self.onOtherResponseNAME, clear=True)
 
     def getResponse(self, query, clear=True):
-        root = self.data if self.conversation is None else self.conversation
+        root = self.__root()
         if "buttons" not in root:
             return None
         query = query.lower()
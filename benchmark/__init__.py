@@ -0,0 +1,466 @@
+"""
+Benchmarks for bothelper. Run all of them with:
+python -m bothelper.benchmark
+Use --json for machine-readable results and --quick for smaller inputs.
+--check only runs the checks: it compares the command index with the linear scan over random
+command sets and checks the chunks of splitText().
+The end-to-end load test of the Flask app is in loadtest.py:
+python -m bothelper.benchmark.loadtest --help
+"""
+import argparse
+import gc
+import json
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from .. import Bot, ServerHelper, User, VagueReply
+
+
+def timeit(fun, *args, repeat=3, **kwargs):
+    """
+    Returns the best wall time of :param repeat: runs in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun(*args, **kwargs)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def perCall(fun, number, repeat=3):
+    """
+    Returns the best time of one call of fun() in microseconds
+    """
+    def loop():
+        for _ in range(number):
+            fun()
+    return timeit(loop, repeat=repeat) / number * 1000000
+
+
+def randomText(size, seed=0):
+    """
+    Returns a text of :param size: characters with words, lines and some very long words
+    """
+    rnd = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", ":cat:", "x" * 120]
+    parts = []
+    length = 0
+    while length < size:
+        word = rnd.choice(words)
+        sep = "\n" if rnd.random() < 0.02 else " "
+        parts.append(word + sep)
+        length += len(word) + 1
+    return "".join(parts)[:size]
+
+
+def benchSplitText(sizes=(1000000, 4000000, 16000000), maxLength=2000):
+    results = []
+    for size in sizes:
+        text = randomText(size)
+        duration = timeit(lambda: sum(1 for _ in ServerHelper.splitText(text, maxLength)))
+        results.append({
+            "name": "splitText",
+            "size": size,
+            "maxLength": maxLength,
+            "seconds": duration,
+            "MBperSecond": size / duration / 1000000
+        })
+    return results
+
+
+class DictUser:
+    """
+    The attribute layout of User before it used __slots__, for comparison
+    """
+
+    def __init__(self, userId, lastMsg=None, storage=None, bot=None):
+        self.__lastMsg = lastMsg
+        self.userId = userId
+        self.bot = bot
+        self.storage = storage
+        self.data = {}
+        self.userdata = {}
+        self.conversation = None
+        self.onOtherResponseNAME = "__onOtherResponse__123"
+
+
+def bytesPerUser(userClass, n):
+    """
+    Returns the allocated bytes per idle user for :param n: users. The user ids are included.
+    """
+    bot = object()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = {}
+    for i in range(n):
+        userId = "@tg:%d" % (100000000 + i)
+        users[userId] = userClass(userId=userId, bot=bot)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del users
+    return (after - before) / n
+
+
+def benchUserMemory(n=1000000):
+    before = bytesPerUser(DictUser, n)
+    after = bytesPerUser(User, n)
+    return [{
+        "name": "userMemory",
+        "users": n,
+        "bytesPerUserBefore": before,
+        "bytesPerUserAfter": after
+    }]
+
+
+class NullPlatform:
+    """
+    A platform bot that drops all messages, for benchmarks without a network
+    """
+    specifications = {
+        "maxMessageLength": 2000
+    }
+
+    def __init__(self):
+        self.sent = 0
+
+    def sendText(self, msg, text, buttons=None):
+        self.sent += 1
+
+    def sendQuestion(self, msg, text, buttons=None):
+        self.sent += 1
+
+    def sendLink(self, msg, url, buttons=None, text=""):
+        self.sent += 1
+
+    def sendPhoto(self, msg, url, buttons=None):
+        self.sent += 1
+
+
+def dispatchBot(numCommands):
+    """
+    Returns a Bot with :param numCommands: commands, a third each of textLike, textStartsWith
+    and textRegexMatch
+    """
+    serv = ServerHelper()
+
+    class DispatchBot(Bot):
+        def onOtherResponse(self, msg):
+            self.sendText(msg, "other")
+
+    for i in range(numCommands):
+        def command(bot, msg):
+            bot.sendText(msg, "ok")
+        command.__name__ = "command%d" % i
+        if i % 3 == 0:
+            serv.textLike("/like%d" % i)(command)
+        elif i % 3 == 1:
+            serv.textStartsWith("start%d " % i)(command)
+        else:
+            serv.textRegexMatch(r"regex%d\s+\d+" % i)(command)
+    return DispatchBot(serv, "Benchmark")
+
+
+def benchDispatch(counts=(10, 100, 1000), number=2000):
+    results = []
+    platform = NullPlatform()
+    for numCommands in counts:
+        bot = dispatchBot(numCommands)
+        last = numCommands - 1
+        texts = {
+            "first": "/like0",
+            "last": ("/like%d", "start%d now", "regex%d 42")[last % 3] % last,
+            "none": "no command matches this text"
+        }
+        for indexCommands in (True, False):
+            bot.serv.indexCommands = indexCommands
+            for case, text in texts.items():
+                def dispatch():
+                    bot.serv._handleTextMessage({"_bot": platform, "_userId": "bench", "text": text})
+                results.append({
+                    "name": "dispatch",
+                    "commands": numCommands,
+                    "indexed": indexCommands,
+                    "match": case,
+                    "microseconds": perCall(dispatch, number)
+                })
+    return results
+
+
+def randomCommands(rnd, numCommands):
+    """
+    Returns a ServerHelper with :param numCommands: random commands of all condition types
+    """
+    serv = ServerHelper()
+    words = ["a", "b", "ab", "ba", "/x", "1"]
+    atoms = [
+        lambda: rnd.choice(words),
+        lambda: "(%s)" % rnd.choice(words),
+        lambda: "(?:%s|%s)+" % (rnd.choice(words), rnd.choice(words)),
+        lambda: r"\d*",
+        lambda: "[ab]?",
+        lambda: ".",
+        lambda: "(a)?b(?(1)c|d)",
+        lambda: "(?P<n>a)?b(?(n)c|d)",
+        lambda: "(?P<n>[ab])(?P=n)",
+        lambda: r"([ab])\1",
+        lambda: "(?=a)",
+        lambda: "$"]
+    for i in range(numCommands):
+        def command(bot, msg):
+            pass
+        command.__name__ = "command%d" % i
+        kind = rnd.randrange(6)
+        if kind == 0:
+            serv.textLike(rnd.choice(words) + rnd.choice(["", " ", "b"]))(command)
+        elif kind == 1:
+            serv.textStartsWith(rnd.choice(words) + rnd.choice(["", "a"]))(command)
+        elif kind in (2, 3):
+            flags = rnd.choice([re.IGNORECASE, 0, re.ASCII | re.IGNORECASE])
+            while True:
+                pattern = "".join(rnd.choice(atoms)() for _ in range(rnd.randint(1, 3)))
+                try:
+                    re.compile(pattern, flags)
+                    break
+                except re.error:  # e.g. a group name that is used twice
+                    pass
+            serv.textRegexMatch(pattern, flags)(command)
+        elif kind == 4:
+            serv.userIdEquals(rnd.choice(["u1", "u2"]))(command)
+        else:
+            serv.all(serv.textStartsWith(rnd.choice(words)), serv.userIdEquals("u1"))(command)
+    return serv
+
+
+def checkCommandIndex(numSets=300, numCommands=40, numTexts=200, seed=0):
+    """
+    Compares the command that the CommandIndex finds with the linear scan over the
+    commands for random command sets and texts. Returns the number of mismatches.
+    """
+    rnd = random.Random(seed)
+    mismatches = 0
+    for _ in range(numSets):
+        serv = randomCommands(rnd, rnd.randint(1, numCommands))
+        for _ in range(numTexts):
+            text = "".join(rnd.choice("abAB1/xcd ") for _ in range(rnd.randint(0, 6)))
+            msg = {"_userId": rnd.choice(["u1", "u2"]), "text_nice": text, "text_nice_lower": text.lower()}
+            serv.indexCommands = True
+            indexed = serv._findCommand(msg)
+            serv.indexCommands = False
+            linear = serv._findCommand(msg)
+            if indexed != linear:
+                mismatches += 1
+                if mismatches <= 10:
+                    print("CommandIndex mismatch for %r: index %s, linear scan %s" % (text, indexed, linear))
+    return [{
+        "name": "commandIndexCheck",
+        "sets": numSets,
+        "texts": numSets * numTexts,
+        "mismatches": mismatches
+    }]
+
+
+def checkSplitText(numTexts=2000, seed=0):
+    """
+    Splits random texts and checks that no chunk is blank or longer than maxLength and that
+    no text besides whitespace is lost. Texts that fit are returned unchanged.
+    Returns the number of failures.
+    """
+    rnd = random.Random(seed)
+    cases = [("   " + "a" * 20, 10), ("\n\n  " + "word " * 10, 12), (" " * 30, 10)]
+    for _ in range(numTexts):
+        # No dots in the text, so the ellipses of cut chunks can be removed again
+        text = "".join(rnd.choice("ab  \n") * rnd.randint(1, 12) for _ in range(rnd.randint(0, 30)))
+        cases.append((text, rnd.randint(7, 40)))
+
+    failures = 0
+    for text, maxLength in cases:
+        chunks = list(ServerHelper.splitText(text, maxLength))
+        problem = None
+        if len(text) <= maxLength:
+            if chunks != [text]:
+                problem = "short text changed"
+        elif any(not chunk.strip() for chunk in chunks):
+            problem = "blank chunk"
+        elif any(len(chunk) > maxLength for chunk in chunks):
+            problem = "chunk longer than maxLength"
+        elif "".join(text.split()) != "".join("".join(chunks).replace(".", "").split()):
+            problem = "text lost"
+        if problem is not None:
+            failures += 1
+            if failures <= 10:
+                print("splitText(%r, %d): %s in %r" % (text, maxLength, problem, chunks))
+    return [{
+        "name": "splitTextCheck",
+        "texts": len(cases),
+        "failures": failures
+    }]
+
+
+def benchResponses(numButtons=(10, 100, 1000), number=2000):
+    results = []
+    vague = VagueReply()
+    for n in numButtons:
+        user = User("bench")
+
+        def action(msg):
+            pass
+
+        buttons = []
+        for i in range(n):
+            buttons.append(("Button %d" % i, "payload%d" % i, [vague.new(["button%d" % i, VagueReply.regex(r"b%d\b" % i)])]))
+        user.rememberResponses(buttons)
+        cases = [
+            ("getResponse", "title", lambda: user.getResponse("button %d" % (n - 1), clear=False)),
+            ("getResponse", "vague", lambda: user.getResponse("b%d" % (n - 1), clear=False)),
+            ("getResponse", "none", lambda: user.getResponse("nothing", clear=False)),
+            ("getButton", "title", lambda: user.getButton("Button %d" % (n - 1), clear=False)),
+            ("getButton", "payload", lambda: user.getButton("payload%d" % (n - 1), clear=False)),
+            ("getButton", "none", lambda: user.getButton("nothing", clear=False))
+        ]
+        for name, case, fun in cases:
+            results.append({
+                "name": name,
+                "buttons": n,
+                "match": case,
+                "microseconds": perCall(fun, max(10, number // n * 10))
+            })
+    return results
+
+
+def benchVagueReply(number=20000):
+    vague = VagueReply()
+    container = vague.new(["yes", "yeah", "yep", "sure", VagueReply.regex(r"y+e+s+"), VagueReply.containsRegex(r"\bok(ay)?\b")])
+    results = []
+    for case, query in (("string", "sure"), ("regex", "yyyesss"), ("containsRegex", "well okay then"), ("none", "no")):
+        results.append({
+            "name": "vagueReply",
+            "match": case,
+            "microseconds": perCall(lambda: container.match(query), number)
+        })
+    return results
+
+
+def benchSendText(sizes=(1000, 100000, 1000000)):
+    platform = NullPlatform()
+    results = []
+    for size in sizes:
+        text = randomText(size)
+        msg = {"_bot": platform, "_userId": "bench"}
+        results.append({
+            "name": "sendText",
+            "size": size,
+            "maxLength": platform.specifications["maxMessageLength"],
+            "microseconds": perCall(lambda: ServerHelper._sendText(msg, text, [("Yes", "yes")]), max(1, 100000 // size))
+        })
+    return results
+
+
+def benchButtonRendering(numButtons=(3, 10, 50), number=2000):
+    """
+    Renders buttons with the Telegram and the Kik bot, with and without the layout cache.
+    The bots are created without their platform clients. Skipped if the library is missing.
+    """
+    results = []
+    serv = ServerHelper()
+    platforms = []
+    try:
+        from ..telegrambot import TelegramBot
+        telegramBot = TelegramBot.__new__(TelegramBot)
+        telegramBot.serv = serv
+        platforms.append(("telegram", telegramBot._reply_markup, telegramBot._renderReplyMarkup))
+    except ImportError as e:
+        results.append({"name": "buttons", "platform": "telegram", "skipped": str(e)})
+    try:
+        from ..kikbot import KikBot
+        kikBot = KikBot.__new__(KikBot)
+        kikBot.serv = serv
+        platforms.append(("kik", kikBot._formatButtons, kikBot._renderKeyboards))
+    except ImportError as e:
+        results.append({"name": "buttons", "platform": "kik", "skipped": str(e)})
+
+    for n in numButtons:
+        buttons = [("Option :thumbs_up: %d" % i, "option%d" % i) for i in range(n)]
+        for platform, cached, uncached in platforms:
+            for isCached, fun in ((True, cached), (False, uncached)):
+                results.append({
+                    "name": "buttons",
+                    "platform": platform,
+                    "buttons": n,
+                    "cached": isCached,
+                    "microseconds": perCall(lambda: fun(buttons), number)
+                })
+    return results
+
+
+def runAll(quick=False):
+    """
+    Runs all benchmarks and returns the list of results
+    """
+    results = []
+    if quick:
+        results += checkCommandIndex(numSets=50)
+        results += checkSplitText(numTexts=200)
+        results += benchDispatch(number=200)
+        results += benchResponses(numButtons=(10, 100), number=200)
+        results += benchVagueReply(number=2000)
+        results += benchSendText(sizes=(1000, 100000))
+        results += benchButtonRendering(number=200)
+        results += benchSplitText(sizes=(1000000,))
+        results += benchUserMemory(n=100000)
+    else:
+        results += checkCommandIndex()
+        results += checkSplitText()
+        results += benchDispatch()
+        results += benchResponses()
+        results += benchVagueReply()
+        results += benchSendText()
+        results += benchButtonRendering()
+        results += benchSplitText()
+        results += benchUserMemory()
+    return results
+
+
+def formatResult(result):
+    parts = [result["name"]]
+    for key, value in result.items():
+        if key == "name":
+            continue
+        if isinstance(value, float):
+            value = "%.3f" % value
+        parts.append("%s=%s" % (key, value))
+    return " ".join(parts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for bothelper")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--quick", action="store_true", help="Smaller inputs and fewer iterations")
+    parser.add_argument("--check", action="store_true", help="Only run the checks of the command index and splitText, exits with 1 on a failure")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        results = checkCommandIndex() + checkSplitText()
+        for result in results:
+            print(formatResult(result))
+        if results[0]["mismatches"] or results[1]["failures"]:
+            sys.exit(1)
+        return results
+
+    results = runAll(args.quick)
+    if args.json:
+        json.dump({
+            "python": sys.version.split()[0],
+            "results": results
+        }, sys.stdout, indent=2)
+        print()
+    else:
+        for result in results:
+            print(formatResult(result))
+    return results
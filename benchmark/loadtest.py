@@ -0,0 +1,342 @@
+"""
+End-to-end load test of the Flask app, from the webhook request through the dispatch
+of the ServerHelper to the reply. Run it with:
+python -m bothelper.benchmark.loadtest --platform html --requests 2000 --concurrency 16
+
+The app is driven in-process with Flask's test client or over localhost with a threaded
+werkzeug server. Replies of the Facebook and Kik bots are sent to a local sink instead of the
+platform APIs, so no network access is required. Kik requires the kik package.
+"""
+import argparse
+import contextlib
+import hashlib
+import hmac
+import json
+import math
+import threading
+import time
+
+from .. import Bot, ServerHelper
+
+
+class LoadTestBot(Bot):
+    def onOtherResponse(self, msg):
+        self.sendText(msg, "You said: %s" % msg["text"])
+
+    def ping(self, msg):
+        self.sendText(msg, "pong", buttons=[("Again", "/ping"), ("Help :thumbs_up:", "/help")])
+
+    def help(self, msg):
+        self.sendText(msg, "This is the load test bot")
+
+
+class ReplySink:
+    """
+    Counts the replies that the bots send to the platform APIs
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.replies = 0
+
+    def count(self, n=1):
+        with self.lock:
+            self.replies += n
+
+
+def facebookSink(sink):
+    """
+    Returns a transport adapter for the requests session of a FacebookBot, that answers all
+    requests like the Graph API does for messages and counts them in :param sink:
+    """
+    import requests
+
+    class FacebookSink(requests.adapters.BaseAdapter):
+        def send(self, request, **kwargs):
+            sink.count()
+            response = requests.Response()
+            response.status_code = 200
+            response._content = b'{"recipient_id": "0", "message_id": "mid.0"}'
+            response.headers["Content-Type"] = "application/json"
+            response.url = request.url
+            response.request = request
+            return response
+
+        def close(self):
+            pass
+
+    return FacebookSink()
+
+
+class Scenario:
+    """
+    Creates the requests for one platform. setup() is called once per worker.
+    request() returns (path, body, headers)
+    """
+    path = "/"
+
+    def setup(self, client, worker):
+        return None
+
+    def text(self, i):
+        return "/ping" if i % 2 else "hello %d" % i
+
+
+class HtmlScenario(Scenario):
+    path = "/chat"
+
+    def setup(self, client, worker):
+        secret = "loadtest%d" % worker
+        body = json.dumps({"init": secret, "text": "/start"}).encode("utf-8")
+        status, data = client.post(self.path, body, {"Content-Type": "application/json"})
+        return {"uid": json.loads(data)["uid"], "secret": secret}
+
+    def request(self, state, i):
+        body = {"uid": state["uid"], "secret": state["secret"], "text": self.text(i)}
+        return self.path, json.dumps(body).encode("utf-8"), {"Content-Type": "application/json"}
+
+
+class FacebookScenario(Scenario):
+    path = "/facebook"
+    app_secret = "loadtest-secret"
+
+    def request(self, state, i):
+        body = json.dumps({
+            "object": "page",
+            "entry": [{
+                "id": "page",
+                "time": int(time.time() * 1000),
+                "messaging": [{
+                    "sender": {"id": "fb%d" % (i % 1000)},
+                    "recipient": {"id": "page"},
+                    "timestamp": int(time.time() * 1000),
+                    "message": {"mid": "mid.%d" % i, "text": self.text(i)}
+                }]
+            }]
+        }).encode("utf-8")
+        signature = "sha1=" + hmac.new(self.app_secret.encode("utf-8"), body, hashlib.sha1).hexdigest()
+        return self.path, body, {"Content-Type": "application/json", "X-Hub-Signature": signature}
+
+
+class KikScenario(Scenario):
+    path = "/kik"
+    apikey = "loadtest-apikey"
+
+    def request(self, state, i):
+        user = "kik%d" % (i % 1000)
+        body = json.dumps({
+            "messages": [{
+                "type": "text",
+                "id": "m%d" % i,
+                "from": user,
+                "chatId": "chat-%s" % user,
+                "participants": [user],
+                "body": self.text(i),
+                "timestamp": int(time.time() * 1000)
+            }]
+        }).encode("utf-8")
+        signature = hmac.new(self.apikey.encode("utf-8"), body, hashlib.sha1).hexdigest().upper()
+        return self.path, body, {"Content-Type": "application/json", "X-Kik-Signature": signature}
+
+
+@contextlib.contextmanager
+def _offlineKik():
+    # KikBot configures the webhook of the Kik API in its constructor
+    import kik
+    set_configuration = kik.KikApi.set_configuration
+    kik.KikApi.set_configuration = lambda self, configuration: configuration
+    try:
+        yield
+    finally:
+        kik.KikApi.set_configuration = set_configuration
+
+
+def buildApp(platform, sink, **kwargs):
+    """
+    Returns the Flask app of a LoadTestBot with a :param platform: bot and its Scenario.
+    The replies are counted by :param sink:
+    """
+    serv = ServerHelper()
+    bot = LoadTestBot(serv, "Load test")
+    serv.textLike("/ping")(LoadTestBot.ping)
+    serv.textLike("/help")(LoadTestBot.help)
+
+    if platform == "html":
+        from ..htmlbot import HtmlBot
+        bot.addFlaskBot(HtmlBot, route=HtmlScenario.path, **kwargs)
+        scenario = HtmlScenario()
+    elif platform == "facebook":
+        from ..facebookbot import FacebookBot
+        facebookBot = bot.addFlaskBot(
+            FacebookBot,
+            route=FacebookScenario.path,
+            app_secret=FacebookScenario.app_secret,
+            verify_token="loadtest",
+            access_token="loadtest",
+            start_message=None,
+            start_button=False,  # Would post to the Graph API before the sink is mounted
+            **kwargs)
+        facebookBot.session.mount("https://", facebookSink(sink))
+        scenario = FacebookScenario()
+    elif platform == "kik":
+        from ..kikbot import KikBot
+        with _offlineKik():
+            kikBot = bot.addFlaskBot(
+                KikBot,
+                route=KikScenario.path,
+                name="loadtest",
+                apikey=KikScenario.apikey,
+                webhook_host="http://127.0.0.1",
+                **kwargs)
+        kikBot.kik_api.send_messages = lambda messages: sink.count(len(messages))
+        scenario = KikScenario()
+    else:
+        raise ValueError("Unknown platform %r" % platform)
+
+    app = bot.run(runFlask=False)
+    return app, serv, scenario
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, path, body, headers):
+        response = self.client.post(path, data=body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    def __init__(self, url):
+        import requests
+        self.url = url
+        self.session = requests.Session()
+
+    def post(self, path, body, headers):
+        response = self.session.post(self.url + path, data=body, headers=headers)
+        return response.status_code, response.content
+
+
+@contextlib.contextmanager
+def _localServer(app, port):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", port, app, threaded=True, request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:%d" % server.server_port
+    finally:
+        server.shutdown()
+
+
+def percentile(sortedValues, p):
+    """
+    Nearest-rank percentile of an ascending list
+    """
+    if not sortedValues:
+        return None
+    k = max(0, min(len(sortedValues) - 1, math.ceil(p / 100.0 * len(sortedValues)) - 1))
+    return sortedValues[k]
+
+
+def loadTest(platform="html", numRequests=1000, concurrency=8, transport="inprocess", port=0, **kwargs):
+    """
+    Sends :param numRequests: requests from :param concurrency: threads and returns the throughput
+    and latency percentiles. :param transport: is "inprocess" or "http"
+    """
+    sink = ReplySink()
+    app, serv, scenario = buildApp(platform, sink, **kwargs)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(numRequests))
+
+    def worker(makeClient, n):
+        client = makeClient()
+        state = scenario.setup(client, n)
+        local = []
+        localErrors = 0
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            path, body, headers = scenario.request(state, i)
+            start = time.perf_counter()
+            status, _ = client.post(path, body, headers)
+            local.append(time.perf_counter() - start)
+            if status >= 400:
+                localErrors += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += localErrors
+
+    with contextlib.ExitStack() as stack:
+        if transport == "http":
+            url = stack.enter_context(_localServer(app, port))
+            makeClient = lambda: HttpClient(url)
+        else:
+            makeClient = lambda: InProcessClient(app)
+
+        threads = [threading.Thread(target=worker, args=(makeClient, n)) for n in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - start
+
+    serv.outbox.flush(30)
+
+    latencies.sort()
+    return {
+        "name": "loadtest",
+        "platform": platform,
+        "transport": transport,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": duration,
+        "requestsPerSecond": len(latencies) / duration if duration else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "replies": sink.replies
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end load test of the bothelper Flask app")
+    parser.add_argument("--platform", choices=("html", "facebook", "kik"), action="append", dest="platforms", help="Can be given multiple times, default: html")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--transport", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--port", type=int, default=0, help="Port of the local server, 0 for a free port")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args(argv)
+
+    platforms = args.platforms or ["html"]
+    results = []
+    for platform in platforms:
+        try:
+            results.append(loadTest(platform, args.requests, args.concurrency, args.transport, args.port))
+        except ImportError as e:
+            print("Skipping %s: %s" % (platform, str(e)))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return results
+    for result in results:
+        print("%(platform)s over %(transport)s, concurrency %(concurrency)d: %(requests)d requests in %(seconds).2fs, "
+              "%(requestsPerSecond).0f req/s, p50 %(p50).4fs, p95 %(p95).4fs, p99 %(p99).4fs, "
+              "%(errors)d errors, %(replies)d replies sent to the platform API" % result)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,10 @@
 import asyncio
+import datetime
+import heapq
+import itertools
+import multiprocessing
+import threading
+import time
 from threading import Thread
 
 # pip
@@ -13,32 +19,112 @@ class DiscordBot:
         "waitForExpectedReply": 360
     }
 
-    def __init__(self, serv, token, prefix=None):
+    def __init__(self, serv, token, prefix=None, shard_count=None, shard_ids=None):
         """
         prefix - A string or tuple of strings
-
+        shard_count - Total number of shards of the bot, None to connect without sharding
+        shard_ids - The shards that are run in this process, by default all of them. Each shard
+        has its own client and its own event loop thread. See runShardProcesses() to spread the
+        shards over multiple processes.
         """
         self.serv = serv
         self.token = token
-        self.client = discord.Client()
         self.prefixes = prefix
         if isinstance(self.prefixes, list):
             self.prefixes = tuple(sorted(self.prefixes, key=len, reverse=True))
         if isinstance(self.prefixes, str) and self.prefixes.strip() == "":
             self.prefixes = None
-        self.sentmessages = []
+        # Sent messages that are waiting for a reply, by (guild id, channel id, author id)
+        self.pendingReplies = {}
+        self.__expiries = []  # Heap of (expires, n, key)
+        self.__counter = itertools.count()
+        self.__repliesLock = threading.Lock()
+        self.loop = None
+
+        self.shard_count = shard_count
+        if shard_count is None:
+            self.shards = [DiscordBot.Shard(None, discord.Client(), None)]
+        else:
+            if shard_ids is None:
+                shard_ids = range(shard_count)
+            self.shards = []
+            for shard_id in shard_ids:
+                loop = asyncio.new_event_loop()
+                client = discord.Client(loop=loop, shard_id=shard_id, shard_count=shard_count)
+                self.shards.append(DiscordBot.Shard(shard_id, client, loop))
+        self.client = self.shards[0].client
+
+        for shard in self.shards:
+            self.__registerEvents(shard)
+
+    class Shard:
+        """
+        A client and its event loop, with latency and event-rate counters
+        """
+        rateInterval = 10.0
+
+        def __init__(self, shard_id, client, loop):
+            self.shard_id = shard_id
+            self.client = client
+            self.loop = loop
+            self.thread = None
+            self.events = 0
+            self.__windowStart = time.monotonic()
+            self.__windowEvents = 0
+            self.__lastWindow = (0, 0.0)  # (events, seconds) of the previous window
+
+        def countEvent(self):
+            # Only called from the event loop of the shard
+            self.events += 1
+            self.__windowEvents += 1
+            now = time.monotonic()
+            if now - self.__windowStart >= self.rateInterval:
+                self.__lastWindow = (self.__windowEvents, now - self.__windowStart)
+                self.__windowStart = now
+                self.__windowEvents = 0
 
-        @self.client.event
+        @property
+        def eventsPerSecond(self):
+            """
+            Event rate of at least the last rateInterval seconds, it decays towards zero while the shard is idle
+            """
+            windowStart, windowEvents = self.__windowStart, self.__windowEvents
+            elapsed = time.monotonic() - windowStart
+            if elapsed >= self.rateInterval:
+                # No event rolled the window over for a while
+                return windowEvents / elapsed
+            lastEvents, lastSeconds = self.__lastWindow
+            if lastSeconds + elapsed <= 0:
+                return 0.0
+            return (lastEvents + windowEvents) / (lastSeconds + elapsed)
+
+        def stats(self):
+            return {
+                "latency": self.client.latency,
+                "events": self.events,
+                "eventsPerSecond": self.eventsPerSecond,
+                "guilds": len(self.client.guilds)
+            }
+
+    def __registerEvents(self, shard):
+        client = shard.client
+
+        @client.event
         async def on_ready():
-            print('DiscordBot logged in')
+            if shard.shard_id is None:
+                print('DiscordBot logged in')
+            else:
+                print('DiscordBot shard %d/%d logged in' % (shard.shard_id, self.shard_count))
 
-        @self.client.event
+        @client.event
         async def on_message(message):
-            self.__on_message(message)
+            shard.countEvent()
+            await self.__on_message(message, shard)
 
-        @self.client.event
+        @client.event
         async def on_guild_join(guild):
-            self.__on_guild_join(guild)
+            shard.countEvent()
+            await self.__on_guild_join(guild, shard)
 
     def run(self):
         def worker(client, loop, token):
@@ -46,21 +132,41 @@ class DiscordBot:
             loop.create_task(client.start(token))
             loop.run_forever()
 
-        loop = asyncio.get_event_loop()
-        t = Thread(target=worker, args=(self.client, loop, self.token))
-        t.daemon = True
-        t.start()
+        for shard in self.shards:
+            if shard.loop is None:
+                shard.loop = asyncio.get_event_loop()
+            t = Thread(target=worker, args=(shard.client, shard.loop, self.token))
+            t.daemon = True
+            t.start()
+            shard.thread = t
+        self.loop = self.shards[0].loop
 
         # self.client.run(self.token)
 
-    def __on_guild_join(self, guild):
+    def wait(self):
+        """
+        Blocks until all shards have stopped
+        """
+        for shard in self.shards:
+            if shard.thread is not None:
+                shard.thread.join()
+
+    def shardStats(self):
+        """
+        Returns the latency in seconds, the number of events and the event rate of the last
+        ten seconds by shard id
+        """
+        return {shard.shard_id: shard.stats() for shard in self.shards}
+
+    async def __on_guild_join(self, guild, shard):
         msg = {
             "_bot": self,
             "_userId": guild.owner.id,
             "text": "/start",
             "__guild": guild,
             "__message": None,
-            "__on_guild_join": True
+            "__on_guild_join": True,
+            "__loop": shard.loop
         }
         channels = []
         for channel in guild.channels:
@@ -73,10 +179,10 @@ class DiscordBot:
         if channels:
             channels.sort(key=lambda c: c.position)
             msg["__channel"] = channels[0]
-            return self.serv._handleTextMessage(msg)
+            return await self.serv._handleTextMessageAsync(msg)
         return
 
-    def __on_message(self, message):
+    async def __on_message(self, message, shard):
         if message.author.bot:  # Do not reply to bot messages
             return
 
@@ -85,16 +191,7 @@ class DiscordBot:
         if self.prefixes is not None:
             if not text.startswith(self.prefixes):
                 # Is this message a reply?
-                is_reply = False
-                for sentmessage in reversed(self.sentmessages):
-                    if sentmessage.message and sentmessage.reply_to and sentmessage.message.guild == message.guild and sentmessage.message.channel == message.channel and sentmessage.reply_to.author == message.author:
-                        diff = message.timestamp - sentmessage.message.timestamp
-                        if (sentmessage.expects_reply and diff.seconds <
-                                self.specifications["waitForExpectedReply"]) or diff.seconds < self.specifications["waitForReply"]:
-                            is_reply = True
-                            self.sentmessages.remove(sentmessage)
-                            break
-                if not is_reply:
+                if not self.__popPendingReply(message):
                     # Do not reply to message
                     return
             else:
@@ -111,17 +208,68 @@ class DiscordBot:
             "__message": message,
             "__channel": message.channel,
             "__author": message.author,
+            "__loop": shard.loop
         }
 
-        return self.serv._handleTextMessage(msg)
+        return await self.serv._handleTextMessageAsync(msg)
 
     class MessageReply:
-        def __init__(self, message, reply_to, expects_reply):
+        def __init__(self, message, reply_to, expects_reply, expires):
             self.message = message
             self.reply_to = reply_to
             self.expects_reply = expects_reply
+            self.expires = expires
+
+    @staticmethod
+    def __replyKey(message, author):
+        return (getattr(message.guild, "id", None), message.channel.id, author.id)
+
+    def __sweepPendingReplies(self, now):
+        """
+        Removes the sent messages that can no longer be replied to
+        """
+        while self.__expiries and self.__expiries[0][0] <= now:
+            _, _, key = heapq.heappop(self.__expiries)
+            pending = self.pendingReplies.get(key)
+            if pending is None:
+                continue
+            pending[:] = [r for r in pending if r.expires > now]
+            if not pending:
+                del self.pendingReplies[key]
+
+    def __addPendingReply(self, sentmessage, reply_to, expects_reply):
+        created_at = sentmessage.created_at
+        wait = self.specifications["waitForExpectedReply"] if expects_reply else self.specifications["waitForReply"]
+        expires = created_at + datetime.timedelta(seconds=wait)
+        key = self.__replyKey(sentmessage, reply_to.author)
+        with self.__repliesLock:  # Shards run in different threads
+            self.__sweepPendingReplies(created_at)
+            self.pendingReplies.setdefault(key, []).append(DiscordBot.MessageReply(sentmessage, reply_to, expects_reply, expires))
+            heapq.heappush(self.__expiries, (expires, next(self.__counter), key))
+
+    def __popPendingReply(self, message):
+        """
+        Removes and returns the latest sent message that :param message: is a reply to, or None
+        """
+        now = message.created_at
+        key = self.__replyKey(message, message.author)
+        with self.__repliesLock:
+            self.__sweepPendingReplies(now)
+            pending = self.pendingReplies.get(key)
+            if not pending:
+                return None
+            for i in range(len(pending) - 1, -1, -1):
+                if pending[i].expires > now:
+                    sentmessage = pending.pop(i)
+                    if not pending:
+                        del self.pendingReplies[key]
+                    return sentmessage
+        return None
 
     def __formatButtons(self, buttons):
+        return self.serv._renderButtons(type(self), buttons, self.__renderButtons)
+
+    def __renderButtons(self, buttons):
         text = ""
         for button in buttons:
             if isinstance(button[1], str):
@@ -135,19 +283,27 @@ class DiscordBot:
 
     async def __send_message2(self, expects_reply, reply_to, destination, *args, **kwargs):
         m = await destination.send(*args, **kwargs)
-        r = DiscordBot.MessageReply(m, reply_to, expects_reply)
-        self.sentmessages.append(r)
-        if len(self.sentmessages) > 1000:
-            self.sentmessages = self.sentmessages[-30:]
+        if m is not None and reply_to is not None:
+            self.__addPendingReply(m, reply_to, expects_reply)
 
     def __send_message(self, msg, expects_reply, *args, **kwargs):
-        asyncio.ensure_future(
-            self.__send_message2(
-                expects_reply,
-                msg["__message"],
-                msg["__channel"],
-                *args,
-                **kwargs))
+        coro = self.__send_message2(
+            expects_reply,
+            msg["__message"],
+            msg["__channel"],
+            *args,
+            **kwargs)
+        # Send from the event loop of the shard that received the message
+        loop = msg.get("__loop") or self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None and (loop is None or running is loop):
+            asyncio.ensure_future(coro)
+        else:
+            # Called from a worker thread of the executor or from another shard
+            asyncio.run_coroutine_threadsafe(coro, loop)
 
     def sendText(self, msg, text, buttons=None):
         text = self.serv._emojize(text)
@@ -186,3 +342,28 @@ class DiscordBot:
             text = self.__formatButtons(buttons)
             embed.description = text
         self.__send_message(msg, False, embed=embed)
+
+
+def _runShards(factory, shard_ids, shard_count):
+    discordBot = factory(shard_ids, shard_count)
+    discordBot.wait()
+
+
+def runShardProcesses(factory, shard_count, processes=None):
+    """
+    Spreads :param shard_count: shards over :param processes: worker processes, by default one
+    per CPU. In each process factory(shard_ids, shard_count) is called. It should create the
+    bot with addBot(DiscordBot, ..., shard_count=shard_count, shard_ids=shard_ids), start it
+    with run() and return the DiscordBot. The factory has to be a module-level function.
+    Returns the started multiprocessing.Process objects.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, shard_count))
+    workers = []
+    for i in range(processes):
+        shard_ids = list(range(i, shard_count, processes))
+        p = multiprocessing.Process(target=_runShards, args=(factory, shard_ids, shard_count), name="DiscordShards-%d" % i)
+        p.start()
+        workers.append(p)
+    return workers
@@ -1,13 +1,18 @@
-import json
+import atexit
 import hmac
 import hashlib
+import threading
+import urllib.parse
 
 # pip
 import requests
+import requests.adapters
+import urllib3.util.retry
 import flask
 
 
-API_URL = "https://graph.facebook.com/v8.0/me/"
+GRAPH_URL = "https://graph.facebook.com/"
+API_URL = GRAPH_URL + "v8.0/me/"
 
 
 class FacebookBot:
@@ -20,8 +25,13 @@ class FacebookBot:
         # https://developers.facebook.com/docs/messenger-platform/send-api-reference/quick-replies
         "maxButtonTitleLength": 20,
         "maxButtons": 11,
+        # https://developers.facebook.com/docs/messenger-platform/send-messages/#sending_rate
+        "sendRate": 250,
+        "sendBurst": 250,
         # https://developers.facebook.com/docs/messenger-platform/reference/messenger-profile-api/get-started-button#properties
-        "getStartedPayloadLength": 1000
+        "getStartedPayloadLength": 1000,
+        # https://developers.facebook.com/docs/graph-api/batch-requests#limits
+        "maxBatchRequests": 50
     }
 
     def __init__(
@@ -33,16 +43,53 @@ class FacebookBot:
             verify_token,
             access_token,
             start_message=None,
-            start_button=True):
+            start_button=True,
+            pool_size=10,
+            timeout=10,
+            retries=3,
+            batch_send=False,
+            batch_delay=0.05,
+            fast_ack=False):
         """
         It is suggested to use a secret :param route: to ensure that nobody can send malicious
         requests.
+        Requests to the Graph API share a pool of up to :param pool_size: keep-alive connections.
+        Requests time out after :param timeout: seconds and are retried up to :param retries: times
+        if the connection fails.
+        If :param batch_send: is True, messages are collected for :param batch_delay: seconds and
+        sent together in Graph API batch requests. Collected messages are sent at exit.
+        If :param fast_ack: is True, the webhook returns after verifying the signature and the
+        events are handled by the webhook queue of the ServerHelper.
         """
 
         self.serv = serv
         self.app_secret = app_secret
         self.verify_token = verify_token
         self.access_token = access_token
+        self.timeout = timeout
+        self.fast_ack = fast_ack
+
+        # The session is shared by all threads, urllib3's connection pool is thread-safe
+        self.session = requests.Session()
+        self.__httpAdapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=urllib3.util.retry.Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                redirect=0,
+                status=0,
+                backoff_factor=0.1))
+        self.session.mount("https://", self.__httpAdapter)
+
+        self.batch_send = batch_send
+        self.batch_delay = batch_delay
+        self.__batch = []
+        self.__batchLock = threading.Lock()
+        self.__batchTimer = None
+        # The timer thread is a daemon, so the collected messages are sent at exit
+        atexit.register(self.__flushBatchAtExit)
 
         endpointGet = "%s.%s@%s" % (self,
                                     self.__onGet.__name__,
@@ -86,11 +133,12 @@ class FacebookBot:
             "Content-Type": "application/json"
         }
 
-        r = requests.post(
+        r = self.session.post(
             API_URL + section,
             params=params,
             headers=headers,
-            data=json.dumps(data))
+            data=self.serv._jsonDumps(data).encode("utf-8"),
+            timeout=self.timeout)
         if r.status_code != 200:
             print(
                 "FacebookBot.__send: %s returned %d" %
@@ -98,6 +146,25 @@ class FacebookBot:
 
         return r
 
+    def connectionStats(self):
+        """
+        Returns the number of requests and of opened connections to the Graph API.
+        reuseRate is the fraction of requests that used an existing connection.
+        """
+        requestCount = 0
+        connectionCount = 0
+        pools = self.__httpAdapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is not None:
+                requestCount += pool.num_requests
+                connectionCount += pool.num_connections
+        return {
+            "requests": requestCount,
+            "connections": connectionCount,
+            "reuseRate": 1 - connectionCount / requestCount if requestCount else 0.0
+        }
+
     def __onGet(self):
         """
         Handle the initial verification of your webhook. This should only be called once when
@@ -112,17 +179,18 @@ class FacebookBot:
 
         return "Missing hub.* parameter", 400
 
-    def __validateRequest(self):
+    def __validateRequest(self, body):
         """
         Verifies that a request body correctly matches the value in the X-Hub-Signature header.
         See `https://developers.facebook.com/docs/messenger-platform/webhook-reference#security`_.
         """
         signature = "sha1=" + hmac.new(
             key=self.app_secret.encode("utf-8"),
-            msg=flask.request.get_data(),
+            msg=body,
             digestmod=hashlib.sha1).hexdigest()
 
-        if flask.request.headers["X-Hub-Signature"] != signature:
+        if not hmac.compare_digest(flask.request.headers.get("X-Hub-Signature", ""), signature):
+            print("__onPost: Validation failed!")
             return False
 
         return True
@@ -135,18 +203,29 @@ class FacebookBot:
         """
         # endpoint for processing incoming messaging events
 
-        try:
-            if not self.__validateRequest():
-                print("__onPost: Validation failed!")
-                return "Signature mismatch", 403
-            data = flask.request.get_json()
-            if data is None:
-                raise RuntimeError("Empty json data")
-        except BaseException:
-            return "Corrupt json data", 400
+        data, error = self.serv._readWebhook(self.__validateRequest)
+        if error is not None:
+            return error
 
         # print(str(data).encode("unicode-escape"))  # Good for testing
 
+        events = self.__events(data)
+
+        if self.fast_ack:
+            if not self.serv._ingest(events):
+                return "Too many requests", 503
+            return "Ok", 200
+
+        for userId, fun, args in events:
+            self.serv._run(userId, fun, *args)
+
+        return "Ok", 200
+
+    def __events(self, data):
+        """
+        Returns the messaging events of a webhook request as a list of (userId, fun, args)
+        """
+        events = []
         if data and "object" in data and data["object"] == "page" and "entry" in data and data["entry"]:
             for entry in data["entry"]:
                 print(data["entry"])
@@ -156,7 +235,10 @@ class FacebookBot:
 
                     if messaging_event.get(
                             "message"):  # someone sent us a message
-                        self.__handleMessage(messaging_event)
+                        events.append((
+                            messaging_event["sender"]["id"],
+                            self.__handleMessage,
+                            (messaging_event,)))
 
                     if messaging_event.get(
                             "delivery"):  # delivery confirmation
@@ -167,11 +249,13 @@ class FacebookBot:
 
                     if messaging_event.get(
                             "postback"):  # user clicked/tapped "postback" button in earlier message
-                        self.__handlePostback(messaging_event)
+                        events.append((
+                            messaging_event["sender"]["id"],
+                            self.__handlePostback,
+                            (messaging_event,)))
         else:
             print("__onPost: No data")
-
-        return "Ok", 200
+        return events
 
     def __handleMessage(self, messaging_event):
         messaging_event["_bot"] = self
@@ -210,7 +294,7 @@ class FacebookBot:
                 messaging_event["text"] = messaging_event["postback"]["title"]
             return self.serv._handleTextMessage(messaging_event)
 
-    def __sendMessage(self, recipient_id, message, buttons):
+    def __messageData(self, recipient_id, message, buttons):
         data = {
             "messaging_type": "RESPONSE",
             "recipient": {
@@ -226,35 +310,132 @@ class FacebookBot:
             buttons = buttons[:self.specifications["maxButtons"]]
 
         if buttons is not None and len(buttons) > 0:
-            # Quick-reply documentation:
-            # https://developers.facebook.com/docs/messenger-platform/send-api-reference/quick-replies
-            quick_replies = []
-            for button in buttons:
+            data["message"]["quick_replies"] = self.serv._renderButtons(type(self), buttons, self.__quickReplies)
 
-                title = self.serv._emojize(button[0])
-                if len(title) > self.specifications["maxButtonTitleLength"]:
-                    print(
-                        "FacebookBot.__sendMessage: Quick-reply/button title has a %d/%d character limit" %
-                        (len(title), self.specifications["maxButtonTitleLength"]))
+        return data
 
-                quick_replies.append({
-                    "content_type": "text",
-                    "title": title[0:self.specifications["maxButtonTitleLength"]],
-                    "payload": button[1] if isinstance(button[1], str) else button[0]
-                })
-            data["message"]["quick_replies"] = quick_replies
+    def __quickReplies(self, buttons):
+        # Quick-reply documentation:
+        # https://developers.facebook.com/docs/messenger-platform/send-api-reference/quick-replies
+        quick_replies = []
+        for button in buttons:
+
+            title = self.serv._emojize(button[0])
+            if len(title) > self.specifications["maxButtonTitleLength"]:
+                print(
+                    "FacebookBot.__sendMessage: Quick-reply/button title has a %d/%d character limit" %
+                    (len(title), self.specifications["maxButtonTitleLength"]))
+
+            quick_replies.append({
+                "content_type": "text",
+                "title": title[0:self.specifications["maxButtonTitleLength"]],
+                "payload": button[1] if isinstance(button[1], str) else button[0]
+            })
+        return quick_replies
 
-        r = self.__send(data)
+    def __sendMessage(self, recipient_id, message, buttons):
+        r = self.__send(self.__messageData(recipient_id, message, buttons))
 
-        ret = json.loads(r.text)
+        ret = self.serv._jsonLoads(r.text)
 
         if "error" in ret:
             print("Could not send message:\n%s" %
                   (r.text.encode('unicode-escape').decode('ascii')))
 
+    def __enqueueMessage(self, recipient_id, message, buttons):
+        if self.batch_send:
+            return self.__addToBatch(self.__messageData(recipient_id, message, buttons))
+        return self.serv._enqueueSend(
+            self, recipient_id, self.__sendMessage, recipient_id, message, buttons)
+
+    def __addToBatch(self, data):
+        with self.__batchLock:
+            self.__batch.append(data)
+            if len(self.__batch) >= self.specifications["maxBatchRequests"]:
+                self.__flushBatchLocked()
+            elif self.__batchTimer is None:
+                self.__batchTimer = threading.Timer(self.batch_delay, self.flushBatch)
+                self.__batchTimer.daemon = True
+                self.__batchTimer.start()
+
+    def flushBatch(self):
+        """
+        Sends the collected messages now
+        """
+        with self.__batchLock:
+            self.__flushBatchLocked()
+
+    def __flushBatchAtExit(self):
+        # The thread pools do not accept new work at exit, so send in this thread. The outbox
+        # has already finished the earlier batches, so the order is kept
+        with self.__batchLock:
+            self.__flushBatchLocked(direct=True)
+
+    def __flushBatchLocked(self, direct=False):
+        if self.__batchTimer is not None:
+            self.__batchTimer.cancel()
+            self.__batchTimer = None
+        batch, self.__batch = self.__batch, []
+        if not batch:
+            return
+        # All batches use the same key, so they are sent in order
+        if self.serv.useOutbox and not direct:
+            self.serv.outbox.put(self, "__batch__", self.__sendBatch, (batch,), tokens=len(batch))
+        else:
+            self.__sendBatch(batch)
+
+    def __sendBatch(self, batch):
+        """
+        Sends up to maxBatchRequests messages in one Graph API batch request.
+        Messages to the same recipient depend on the previous one, so they are delivered in order.
+        See `https://developers.facebook.com/docs/graph-api/batch-requests`_
+        """
+        relative_url = API_URL[len(GRAPH_URL):] + "messages"
+        requests_ = []
+        lastRequestName = {}
+        for i, data in enumerate(batch):
+            name = "m%d" % i
+            request = {
+                "method": "POST",
+                "relative_url": relative_url,
+                "name": name,
+                "omit_response_on_success": False,
+                "body": urllib.parse.urlencode({key: self.serv._jsonDumps(value) if not isinstance(value, str) else value for key, value in data.items()})
+            }
+            recipient_id = data["recipient"]["id"]
+            if recipient_id in lastRequestName:
+                request["depends_on"] = lastRequestName[recipient_id]
+            lastRequestName[recipient_id] = name
+            requests_.append(request)
+
+        r = self.session.post(
+            GRAPH_URL,
+            params={"access_token": self.access_token},
+            data={"batch": self.serv._jsonDumps(requests_), "include_headers": "false"},
+            timeout=self.timeout)
+
+        try:
+            responses = self.serv._jsonLoads(r.text)
+        except ValueError:
+            responses = None
+        if r.status_code != 200 or not isinstance(responses, list):
+            print("FacebookBot.__sendBatch: %s returned %d for %d messages:\n%s" %
+                  (GRAPH_URL, r.status_code, len(batch), r.text.encode('unicode-escape').decode('ascii')))
+            return
+
+        # The responses are in the same order as the requests
+        for data, response in zip(batch, responses):
+            if response is None:
+                print("Could not send message (not executed):\n%s" %
+                      self.serv._jsonDumps(data["message"]).encode('unicode-escape').decode('ascii'))
+            elif response.get("code") != 200:
+                print("Could not send message:\n%s\n%s" %
+                      (self.serv._jsonDumps(data["message"]).encode('unicode-escape').decode('ascii'),
+                       str(response.get("body")).encode('unicode-escape').decode('ascii')))
+
     def sendText(self, msg, text, buttons=None):
 
-        return self.__sendMessage(msg["_userId"], {
+        return self.__enqueueMessage(msg["_userId"], {
             "text": self.serv._emojize(text)
         }, buttons)
 
@@ -278,7 +459,7 @@ class FacebookBot:
 
         # Ref.:
         # https://developers.facebook.com/docs/messenger-platform/reference/buttons/url
-        return self.__sendMessage(msg["_userId"], {
+        return self.__enqueueMessage(msg["_userId"], {
             "attachment": {
                 "type": "template",
                 "payload": {
@@ -299,7 +480,7 @@ class FacebookBot:
 
     def sendPhoto(self, msg, url, buttons=None):
 
-        return self.__sendMessage(msg["_userId"], {
+        return self.__enqueueMessage(msg["_userId"], {
             "attachment": {
                 "type": "image",
                 "payload": {
@@ -325,7 +506,7 @@ class FacebookBot:
 
         r = self.__send(data, section="messenger_profile")
 
-        ret = json.loads(r.text)
+        ret = self.serv._jsonLoads(r.text)
 
         if ret["result"] != "success":
             raise RuntimeError(
@@ -344,7 +525,7 @@ class FacebookBot:
 
         r = self.__send(data, section="messenger_profile")
 
-        ret = json.loads(r.text)
+        ret = self.serv._jsonLoads(r.text)
 
         if ret["result"] != "success":
             raise RuntimeError(
@@ -1,7 +1,10 @@
-import json
-import random
 import os
 import html
+import hmac
+import secrets
+import threading
+import time
+import collections
 
 # pip
 import flask
@@ -9,11 +12,21 @@ import flask
 
 class HtmlBot:
     specifications = {
-        "maxMessageLength": 10000
+        "maxMessageLength": 10000,
+        "longPollTimeout": 25,  # Seconds a POST with "wait" is held open if there are no replies
+        "eventStreamKeepAlive": 15  # Seconds between keep-alive comments on the event stream
     }
 
-    def __init__(self, serv, flaskserver, route):
+    def __init__(self, serv, flaskserver, route, session_timeout=3600, max_queued_replies=100):
+        """
+        Sessions that have not polled for :param session_timeout: seconds are removed together
+        with their user. Requests for a removed session are answered with 410, the page then
+        starts a new session.
+        At most :param max_queued_replies: replies are queued per session, the oldest are dropped.
+        """
         self.serv = serv
+        self.session_timeout = session_timeout
+        self.max_queued_replies = max_queued_replies
 
         endpointGet = "%s.%s@%s" % (self,
                                     self.__onGet.__name__,
@@ -21,6 +34,9 @@ class HtmlBot:
         endpointPost = "%s.%s@%s" % (self,
                                      self.__onPost.__name__,
                                      route)  # Unique endpoint name
+        endpointEvents = "%s.%s@%s" % (self,
+                                       self.__onEvents.__name__,
+                                       route)  # Unique endpoint name
 
         flaskserver.route(
             route,
@@ -32,9 +48,17 @@ class HtmlBot:
             methods=['POST'],
             endpoint=endpointPost)(
             self.__onPost)
+        flaskserver.route(
+            route.rstrip("/") + "/events",
+            methods=['GET'],
+            endpoint=endpointEvents)(
+            self.__onEvents)
 
         self.users = {}
         self.replies_queue = {}
+        self.__queueLock = threading.Lock()
+        self.__queueConditions = {}  # One condition per user, all share the lock
+        self.__lastSeen = collections.OrderedDict()  # Least recently seen session first
 
         with open(os.path.join(os.path.dirname(__file__), "chat.html")) as fs:
             self.html = fs.read()
@@ -45,34 +69,65 @@ class HtmlBot:
 
     def __onPost(self):
         # endpoint for processing incoming messaging events
-        try:
-            data = flask.request.get_json()
-            if data is None:
-                raise RuntimeError("Empty json data")
-        except BaseException:
-            return "Corrupt json data", 400
+        data, error = self.serv._readWebhook()
+        if error is not None:
+            return error
 
         #print(str(data).encode("unicode-escape"))
 
         # validate
         if "init" in data:
-            uid = str(random.randint(0, 100))
-            while uid in self.users:
-                uid = str(random.randint(0, 1000000))
-            self.users[uid] = data["init"]
+            uid = secrets.token_urlsafe(16)
+            self.__touch(uid, str(data["init"]), create=True)
             data["uid"] = uid
         else:
-            if data["uid"] in self.users and self.users[data["uid"]
-                                                        ] != data["secret"]:
-                return '{"error": "secret mismatch"}', 403
-            uid = data["uid"]
+            uid = data.get("uid")
+            error = self.__touch(uid, data.get("secret"))
+            if error is not None:
+                return error
 
         if "text" in data:
-            return json.dumps(
-                {"uid": uid, "replies": self.__handleMessage(data)}), 200
+            replies = self.serv._run(uid, self.__handleMessage, data)
+            return self.serv._jsonDumps(
+                {"uid": uid, "replies": replies}), 200
         else:
-            return json.dumps(
-                {"uid": uid, "replies": self.__popQueuedReplies(data)}), 200
+            # Poll. With "wait" the request is held open until a reply is queued (long-poll)
+            timeout = 0
+            if data.get("wait"):
+                try:
+                    timeout = float(data["wait"])
+                except (TypeError, ValueError):
+                    return '{"error": "wait has to be a number"}', 400
+                if not 0 <= timeout <= self.specifications["longPollTimeout"]:
+                    # Also rejects nan
+                    timeout = self.specifications["longPollTimeout"] if timeout > 0 else 0
+            return self.serv._jsonDumps(
+                {"uid": uid, "replies": self.__popQueuedReplies(uid, timeout)}), 200
+
+    def __onEvents(self):
+        # Server-Sent Events stream of the queued replies
+        uid = flask.request.args.get("uid")
+        secret = flask.request.args.get("secret")
+        error = self.__touch(uid, secret)
+        if error is not None:
+            return error
+
+        def stream():
+            yield "retry: 3000\n\n"
+            while True:
+                if self.__touch(uid, secret) is not None:
+                    # The session was removed
+                    return
+                replies = self.__popQueuedReplies(uid, self.specifications["eventStreamKeepAlive"])
+                if replies:
+                    yield "data: %s\n\n" % self.serv._jsonDumps(replies)
+                else:
+                    yield ": keep-alive\n\n"
+
+        return flask.Response(
+            stream(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
     def __handleMessage(self, msg):
         msg["_bot"] = self
@@ -89,15 +144,72 @@ class HtmlBot:
         msg["_responseSent"] = True
         return msg["_responseMessages"]
 
-    def __popQueuedReplies(self, msg):
-        uid = msg["uid"]
+    def __touch(self, uid, secret, create=False):
+        """
+        Marks the session as active and removes the sessions that have been idle for too long.
+        Returns None or an error response if the session does not exist or the secret is wrong.
+        Unknown sessions are only created with :param create:, so nobody can take over the uid
+        of an expired session.
+        """
+        now = time.monotonic()
+        removed = []
+        with self.__queueLock:
+            expired = now - self.session_timeout
+            while self.__lastSeen:
+                oldest, lastSeen = next(iter(self.__lastSeen.items()))
+                if lastSeen > expired:
+                    break
+                del self.__lastSeen[oldest]
+                self.users.pop(oldest, None)
+                self.replies_queue.pop(oldest, None)
+                condition = self.__queueConditions.pop(oldest, None)
+                if condition is not None:
+                    condition.notify_all()
+                removed.append(oldest)
 
-        if uid not in self.replies_queue:
-            return []
+            if create:
+                self.users[uid] = secret
+                error = None
+            elif not isinstance(uid, str) or not isinstance(secret, str):
+                error = '{"error": "uid and secret required"}', 400
+            elif uid not in self.users:
+                error = '{"error": "session expired"}', 410
+            elif not hmac.compare_digest(self.users[uid].encode("utf-8"), secret.encode("utf-8")):
+                error = '{"error": "secret mismatch"}', 403
+            else:
+                error = None
+            if error is None:
+                self.__lastSeen[uid] = now
+                self.__lastSeen.move_to_end(uid)
 
-        replies = self.replies_queue[uid]
-        self.replies_queue[uid] = []
-        return replies
+        # The uids are never used again, so the users of removed sessions are dropped
+        bot = self.serv.bot
+        if bot is not None:
+            for uid in removed:
+                bot.removeUser(uid)
+        return error
+
+    def __queueCondition(self, uid):
+        # Call with self.__queueLock held
+        condition = self.__queueConditions.get(uid)
+        if condition is None:
+            condition = self.__queueConditions[uid] = threading.Condition(self.__queueLock)
+        return condition
+
+    def __popQueuedReplies(self, uid, timeout=0):
+        """
+        Returns the queued replies of the user. Waits up to :param timeout: seconds for a reply if there is none
+        """
+        with self.__queueLock:
+            if timeout > 0 and not self.replies_queue.get(uid):
+                self.__queueCondition(uid).wait_for(lambda: self.replies_queue.get(uid), timeout)
+
+            if not self.replies_queue.get(uid):
+                return []
+
+            replies = list(self.replies_queue[uid])
+            self.replies_queue[uid].clear()
+            return replies
 
     def __sendToQueue(self, msg, text, formattedbuttons):
         # queue the reply for the next polling event
@@ -109,10 +221,15 @@ class HtmlBot:
             "buttons": formattedbuttons
         }
 
-        if uid not in self.replies_queue:
-            self.replies_queue[uid] = [reply]
-        else:
+        with self.__queueLock:
+            if uid not in self.users:
+                # The session has expired
+                return
+            if uid not in self.replies_queue:
+                self.replies_queue[uid] = collections.deque(maxlen=self.max_queued_replies)
             self.replies_queue[uid].append(reply)
+            # Wake up a waiting long-poll or event stream
+            self.__queueCondition(uid).notify_all()
 
     def __formatButtons(self, buttons):
         def formatButton(button):
@@ -123,7 +240,7 @@ class HtmlBot:
 
         b = None
         if buttons:
-            b = [formatButton(button) for button in buttons]
+            b = self.serv._renderButtons(type(self), buttons, lambda buttons: [formatButton(button) for button in buttons])
         return b
 
     def sendText(self, msg, text, buttons=None):
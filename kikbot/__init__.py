@@ -3,9 +3,6 @@ import flask
 import kik
 import kik.messages
 
-import threading
-import time
-
 from pprint import pprint
 
 
@@ -17,15 +14,20 @@ class KikBot:
         "maxMessagesPerBatch": 25,  # https://dev.kik.com/#/docs/messaging#rate-limits
         "maxBroadcastsPerBatch": 100,  # https://dev.kik.com/#/docs/messaging#rate-limits
         "waitBetweenBatches": 2,
+        # Token bucket for the outbox: maxMessagesPerBatch per waitBetweenBatches
+        "sendRate": 12.5,
+        "sendBurst": 25,
         "restrictedChars": {
             "\x84": "\"",
         }
 
     }
 
-    def __init__(self, serv, flaskserver, route, name, apikey, webhook_host):
+    def __init__(self, serv, flaskserver, route, name, apikey, webhook_host, fast_ack=False):
         """
         It is suggested to use a secret :param route: to ensure that nobody can send malicious requests.
+        If :param fast_ack: is True, the webhook returns after verifying the signature and the
+        messages are handled by the webhook queue of the ServerHelper.
         """
         endpoint = "%s.%s@%s" % (self,
                                  self.__incoming.__name__,
@@ -38,6 +40,7 @@ class KikBot:
             self.__incoming)
 
         self.serv = serv
+        self.fast_ack = fast_ack
 
         self.kik_api = kik.KikApi(name, apikey)
         self.kik_api.set_configuration(
@@ -45,10 +48,8 @@ class KikBot:
                 webhook=webhook_host + route))
 
     def _sanitize(self, text):
-        for key in self.specifications["restrictedChars"]:
-            text = text.replace(
-                key, self.specifications["restrictedChars"][key])
-        return text
+        return self.serv._translate(
+            text, self.specifications["restrictedChars"])
 
     def __incoming(self):
         """
@@ -59,27 +60,55 @@ class KikBot:
         # verify that this is a valid request
         # TODO verify timestamp as suggested at:
         # https://dev.kik.com/#/docs/messaging#api-authentication-with-webhook
-        if not self.kik_api.verify_signature(
-                flask.request.headers.get("X-Kik-Signature"),
-                flask.request.get_data()):
-            return "Verification token mismatch", 403
+        data, error = self.serv._readWebhook(lambda body: self.kik_api.verify_signature(
+            flask.request.headers.get("X-Kik-Signature"), body))
+        if error is not None:
+            return error
+
+        messages = data["messages"]
 
-        messages = flask.request.json["messages"]
+        if self.fast_ack:
+            events = [(message["from"], self.__handleAndSend, (message,)) for message in messages]
+            if not self.serv._ingest(events):
+                return "Too many requests", 503
+            return "Ok", 200
 
+        self.__handleMessages(messages)
+
+        return "Ok", 200
+
+    def __handleMessages(self, messages):
         response_messages = []
 
         for message in messages:
 
-            ret = self.__handleMessage(message)
+            ret = self.serv._run(
+                message["from"], self.__handleMessage, message)
 
             if isinstance(ret, kik.messages.TextMessage):
                 response_messages.append(ret)
             elif isinstance(ret, list):
                 response_messages.extend(ret)
 
-        self.__sendMessages(response_messages)
+        self.__enqueueMessages(response_messages)
 
-        return "Ok", 200
+    def __handleAndSend(self, message):
+        self.__enqueueMessages(self.__handleMessage(message))
+
+    def __enqueueMessages(self, response_messages):
+        # Kik has one rate limit for all users, so all messages go through the same queue.
+        # The messages are counted against the rate limit in __sendMessages()
+        if not response_messages:
+            return
+        if not self.serv.useOutbox:
+            return self.__sendMessages(response_messages)
+        self.serv.outbox.put(
+            self, None, self.__sendMessages, (response_messages,), tokens=0)
+
+    def __throttle(self, messages):
+        bucket = self.serv.outbox.bucket(self)
+        if bucket is not None:
+            bucket.acquire(len(messages))
 
     def __sendMessages(self, response_messages):
         if not response_messages:
@@ -115,16 +144,13 @@ class KikBot:
                     i += 1
 
                 if current_batch:
-                    # Send batch
+                    # Send batch, the token bucket waits between batches
                     self.__sendMessages(current_batch)
 
                 remaining = next_batch + remaining[N:]
 
-                if current_batch and remaining:
-                    # Wait before sending the next batch
-                    time.sleep(specifications["waitBetweenBatches"])
-
         else:
+            self.__throttle(response_messages)
             self.kik_api.send_messages(response_messages)
 
     def __sendBroadcasts(self, response_messages):
@@ -161,16 +187,13 @@ class KikBot:
                     i += 1
 
                 if current_batch:
-                    # Send batch
+                    # Send batch, the token bucket waits between batches
                     self.__sendBroadcasts(current_batch)
 
                 remaining = next_batch + remaining[N:]
 
-                if current_batch and remaining:
-                    # Wait before sending the next batch
-                    time.sleep(specifications["waitBetweenBatches"])
-
         else:
+            self.__throttle(response_messages)
             self.kik_api.send_broadcast(response_messages)
 
     def __handleMessage(self, message):
@@ -238,17 +261,18 @@ class KikBot:
             batch, remaining = message["_responseMessages"][0:self.specifications["maxMessagesPerUser"]
                                                             ], message["_responseMessages"][self.specifications["maxMessagesPerUser"]:]
 
-            t = threading.Thread(
-                target=self.kik_api.send_messages, args=(
-                    remaining, 5))
-            t.daemon = True
-            t.start()
+            self.__enqueueMessages(remaining)
 
             return batch
 
         return message["_responseMessages"]
 
     def _formatButtons(self, buttons):
+        if buttons is None:
+            return None
+        return self.serv._renderButtons(type(self), buttons, self._renderKeyboards)
+
+    def _renderKeyboards(self, buttons):
         keyboards = None
         if buttons is not None:
             responses = []
@@ -291,7 +315,7 @@ class KikBot:
         if msg["_responseSent"]:
             # The original message was already sent back, so we need to send
             # the reply separately
-            self.__sendMessages(msg["_responseMessages"])
+            self.__enqueueMessages(msg["_responseMessages"][-1:])
 
     def broadcastText(self, broadcasts, batch=None):
         """
@@ -312,7 +336,10 @@ class KikBot:
             )
             )
 
-        self.__sendBroadcasts(batch)
+        if not self.serv.useOutbox:
+            return self.__sendBroadcasts(batch)
+        self.serv.outbox.put(
+            self, None, self.__sendBroadcasts, (batch,), tokens=0)
 
     def sendLink(self, msg, url, buttons=None, text=""):
         keyboards = self._formatButtons(buttons)
@@ -341,7 +368,7 @@ class KikBot:
         if msg["_responseSent"]:
             # The original message was already sent back, so we need send the
             # reply separately
-            self.__sendMessages(msg["_responseMessages"])
+            self.__enqueueMessages(msg["_responseMessages"][-1:])
 
     def sendPhoto(self, msg, url, buttons=None):
         keyboards = self._formatButtons(buttons)
@@ -360,4 +387,4 @@ class KikBot:
         if msg["_responseSent"]:
             # The original message was already sent back, so we need send the
             # reply separately
-            self.__sendMessages(msg["_responseMessages"])
+            self.__enqueueMessages(msg["_responseMessages"][-1:])
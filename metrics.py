@@ -0,0 +1,155 @@
+# builtin
+import bisect
+import threading
+import time
+
+# pip
+import flask
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges in the Prometheus text format.
+    Labels are given as a tuple of (name, value) pairs.
+    Enable it with Bot.enableMetrics(), it does not cost anything while it is disabled.
+    """
+
+    contentType = "text/plain; version=0.0.4; charset=utf-8"
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    descriptions = {
+        "bothelper_webhook_read_seconds": ("histogram", "Time to read, verify and decode a webhook request"),
+        "bothelper_ingest_seconds": ("histogram", "Time the platform bots spend on an incoming message"),
+        "bothelper_dispatch_seconds": ("histogram", "Time to resolve and run the handler of a message"),
+        "bothelper_resolve_seconds": ("histogram", "Time to find the handler of a message"),
+        "bothelper_handler_seconds": ("histogram", "Time spent in the handler of a command"),
+        "bothelper_unhandled_messages_total": ("counter", "Messages without a matching handler"),
+        "bothelper_send_seconds": ("histogram", "Time spent in the send methods of the platform bots"),
+        "bothelper_outbox_send_seconds": ("histogram", "Time of the platform API calls made by the outbox"),
+        "bothelper_http_request_seconds": ("histogram", "Time of the requests to the Flask routes"),
+        "bothelper_users": ("gauge", "Users in memory"),
+        "bothelper_executor_queue_depth": ("gauge", "Messages waiting for the executor"),
+        "bothelper_outbox_queue_depth": ("gauge", "Messages waiting in the outbox"),
+        "bothelper_webhook_queue_depth": ("gauge", "Webhook events waiting in the webhook queue")
+    }
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}  # name -> {labels: value}
+        self.__histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+        self.__gauges = {}  # name -> {labels: function}
+
+    def inc(self, name, labels=(), value=1):
+        with self.__lock:
+            series = self.__counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.__lock:
+            series = self.__histograms.setdefault(name, {})
+            values = series.get(labels)
+            if values is None:
+                values = series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            values[index] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    def observeTiming(self, name, labels, start, end, msg=None):
+        """
+        Timing hook of the ServerHelper
+        """
+        self.observe(name, labels, end - start)
+
+    def gauge(self, name, function, labels=()):
+        """
+        function() is called to get the value of the gauge whenever the metrics are rendered
+        """
+        with self.__lock:
+            self.__gauges.setdefault(name, {})[labels] = function
+
+    @staticmethod
+    def __labels(labels, extra=None):
+        pairs = list(labels)
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            escaped.append('%s="%s"' % (key, value))
+        return "{" + ",".join(escaped) + "}"
+
+    def __header(self, lines, name, kind):
+        kind, text = self.descriptions.get(name, (kind, name))
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text format
+        """
+        with self.__lock:
+            counters = {name: dict(series) for name, series in self.__counters.items()}
+            histograms = {name: {labels: list(values) for labels, values in series.items()} for name, series in self.__histograms.items()}
+            gauges = {name: dict(series) for name, series in self.__gauges.items()}
+
+        lines = []
+        for name in sorted(counters):
+            self.__header(lines, name, "counter")
+            for labels, value in counters[name].items():
+                lines.append("%s%s %s" % (name, self.__labels(labels), value))
+
+        for name in sorted(histograms):
+            self.__header(lines, name, "histogram")
+            for labels, values in histograms[name].items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, values):
+                    cumulative += count
+                    lines.append("%s_bucket%s %d" % (name, self.__labels(labels, ("le", repr(bound))), cumulative))
+                lines.append("%s_bucket%s %d" % (name, self.__labels(labels, ("le", "+Inf")), values[-1]))
+                lines.append("%s_sum%s %r" % (name, self.__labels(labels), values[-2]))
+                lines.append("%s_count%s %d" % (name, self.__labels(labels), values[-1]))
+
+        for name in sorted(gauges):
+            self.__header(lines, name, "gauge")
+            for labels, function in gauges[name].items():
+                try:
+                    value = function()
+                except Exception as e:
+                    print("Metrics: gauge %s failed: %s" % (name, str(e)))
+                    continue
+                lines.append("%s%s %s" % (name, self.__labels(labels), value))
+
+        return "\n".join(lines) + "\n"
+
+    def instrumentFlask(self, app):
+        """
+        Measures the requests to all routes of the Flask app. The hooks are only added once per
+        app, later calls switch them to these metrics. The first call has to happen before the app
+        serves a request, otherwise a RuntimeError is raised.
+        """
+        registered = "bothelper.metrics" in app.extensions
+        if not registered and getattr(app, "_got_first_request", False):
+            raise RuntimeError("Metrics.instrumentFlask() has to be called before the Flask app serves requests")
+        app.extensions["bothelper.metrics"] = self
+        if registered:
+            return
+
+        @app.before_request
+        def metricsStart():
+            flask.g.bothelperMetricsStart = time.perf_counter()
+
+        @app.after_request
+        def metricsEnd(response):
+            start = getattr(flask.g, "bothelperMetricsStart", None)
+            metrics = flask.current_app.extensions.get("bothelper.metrics")
+            if start is not None and metrics is not None:
+                rule = flask.request.url_rule
+                labels = (
+                    ("route", rule.rule if rule is not None else "<unmatched>"),
+                    ("method", flask.request.method),
+                    ("status", response.status_code))
+                metrics.observe("bothelper_http_request_seconds", labels, time.perf_counter() - start)
+            return response
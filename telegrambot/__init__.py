@@ -1,9 +1,16 @@
+import asyncio
+import traceback
+from threading import Thread
+
 # pip
-import telepot
-import telepot.loop
-import telepot.namedtuple
 try:
-    import flask  # You only need this, if you want to run the webhook variant
+    import telepot  # You only need this, if you want to run the telepot variants
+    import telepot.loop
+    import telepot.namedtuple
+except:
+    pass
+try:
+    import aiohttp  # You only need this, if you want to run the asyncio variant
 except:
     pass
 
@@ -18,30 +25,39 @@ class TelegramBot:
     specifications = {
         "maxMessageLength": 4096,
         "truncateInlineButtonTitle": 40,  # Chararacters. This is a guess, there's nothing in the official documentation
-        "maxInlineButtonPerLine": 6
+        "maxInlineButtonPerLine": 6,
+        # https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+        "sendRate": 30,
+        "sendBurst": 30
         }
 
     DISABLEDBUTTON = "<DISABLEDBUTTON>"
 
-    def __init__(self, serv, flaskserver, route, token, webhook_host):
+    def __init__(self, serv, flaskserver, route, token, webhook_host, fast_ack=False, answer_callback_first=False):
         """
         The Telegram webhook relies on security by obscurity. It's important that :param route:
         is secret and cannot be guessed, because there is no other way to ensure that messages
         are actually coming from a legit telegram server.
         The Telegram API documentation suggests that you use your token.
+        If :param fast_ack: is True, updates are passed on through the bounded webhook queue of the
+        ServerHelper without waiting and the webhook asks Telegram to retry later if it is full.
+        Button clicks are acknowledged concurrently with the handler. If :param answer_callback_first:
+        is True, the callback query is answered before the clicked button is marked.
         """
         endpoint = "%s.%s@%s" % (self, self.__incoming.__name__, route)  # Unique endpoint name
         flaskserver.route(route, methods=["GET", "POST"], endpoint=endpoint)(self.__incoming)
         self.__webhook_host = webhook_host
         self.__route = route
-        self._init(serv, token)
+        self.fast_ack = fast_ack
+        self._init(serv, token, answer_callback_first)
 
-    def _init(self, serv, token):
+    def _init(self, serv, token, answer_callback_first=False):
         self.serv = serv
+        self.answer_callback_first = answer_callback_first
         self.telepotBot = telepot.Bot(token)
         self._handle = {
-            'chat': self.__handleMessage,
-            'callback_query': self.__handleCallbackQuery
+            'chat': lambda message: self.serv._submit(self.userIdFromFrom(message["from"]["id"]), self.__handleMessage, message),
+            'callback_query': lambda callbackquery: self.serv._submit(self.userIdFromFrom(callbackquery["from"]["id"]), self.__handleCallbackQuery, callbackquery)
             }
 
     def run(self):
@@ -50,7 +66,15 @@ class TelegramBot:
         self.telepotBot.setWebhook(self.__webhook_host+self.__route)
 
     def __incoming(self):
-        self.__webhook.feed(flask.request.data)
+        update, error = self.serv._readWebhook()
+        if error is not None:
+            return error
+        if self.fast_ack:
+            # One key for the bot, telepot orders the updates by update_id
+            if not self.serv._ingest([((self, "webhook"), self.__webhook.feed, (update,))]):
+                return 'Too many requests', 503
+            return 'OK'
+        self.__webhook.feed(update)
         return 'OK'
 
     @staticmethod
@@ -75,8 +99,12 @@ class TelegramBot:
 
     def __handleCallbackQuery(self, callbackquery):
         query_id, from_id, query_data = telepot.glance(callbackquery, flavor='callback_query')
+        # The acknowledgement has its own key in the outbox, so it does not wait for replies to the user
+        key = (self, "callback", query_id)
         if TelegramBot.DISABLEDBUTTON == query_data:
-            return self.telepotBot.answerCallbackQuery(query_id)
+            return self.serv._enqueueSend(self, key, self.telepotBot.answerCallbackQuery, query_id)
+        if self.answer_callback_first:
+            self.serv._enqueueSend(self, key, self.telepotBot.answerCallbackQuery, query_id)
         msg = {
             "_bot": self,
             "_userId": self.userIdFromFrom(from_id),
@@ -85,19 +113,21 @@ class TelegramBot:
         }
         selectedButton = telepot.namedtuple.InlineKeyboardButton(text=self.serv._emojize("%s :check_mark_button:" % query_data), callback_data=TelegramBot.DISABLEDBUTTON)
         reply_markup = telepot.namedtuple.InlineKeyboardMarkup(inline_keyboard=[[selectedButton]])
-        self.telepotBot.editMessageReplyMarkup(msg_identifier=(from_id, callbackquery["message"]["message_id"]), reply_markup=reply_markup)
-        self.serv._handleButtonClick(msg)
-        return self.telepotBot.answerCallbackQuery(query_id)
+        self.serv._enqueueSend(self, key, self.telepotBot.editMessageReplyMarkup, msg_identifier=(from_id, callbackquery["message"]["message_id"]), reply_markup=reply_markup)
+        if not self.answer_callback_first:
+            self.serv._enqueueSend(self, key, self.telepotBot.answerCallbackQuery, query_id)
+        return self.serv._handleButtonClick(msg)
 
-    def _reply_markup(self, buttons):
-        if not buttons:
-            return None
+    def _layoutButtons(self, buttons):
+        """
+        Returns the rows of the inline keyboard as lists of (text, callback_data)
+        """
         inlineKeyboardButtons = []
         charsInRow = 0
         currentRow = []
         for button in buttons:
             realtxt = self.serv._emojize(button[0])
-            inlineKeyboardButton = telepot.namedtuple.InlineKeyboardButton(text=self.serv._emojize(button[0]), callback_data=button[1] if isinstance(button[1], str) else button[0])
+            inlineKeyboardButton = (realtxt, button[1] if isinstance(button[1], str) else button[0])
 
             if charsInRow + len(realtxt) < self.specifications["truncateInlineButtonTitle"] and len(currentRow) < self.specifications["maxInlineButtonPerLine"]:
                 # Append button to current row
@@ -113,13 +143,22 @@ class TelegramBot:
         # Last row
         if currentRow:
             inlineKeyboardButtons.append(currentRow)
+        return inlineKeyboardButtons
+
+    def _reply_markup(self, buttons):
+        if not buttons:
+            return None
+        return self.serv._renderButtons(type(self), buttons, self._renderReplyMarkup)
+
+    def _renderReplyMarkup(self, buttons):
+        inlineKeyboardButtons = [[telepot.namedtuple.InlineKeyboardButton(text=text, callback_data=data) for text, data in row] for row in self._layoutButtons(buttons)]
         reply_markup = telepot.namedtuple.InlineKeyboardMarkup(inline_keyboard=inlineKeyboardButtons)
         return reply_markup
 
     def sendText(self, msg, text, buttons=None):
         return_id = self.fromFromMsg(msg)
         reply_markup = self._reply_markup(buttons)
-        self.telepotBot.sendMessage(return_id, self.serv._emojize(text), reply_markup=reply_markup)
+        self.serv._enqueueSend(self, return_id, self.telepotBot.sendMessage, return_id, self.serv._emojize(text), reply_markup=reply_markup)
 
     def sendQuestion(self, msg, text, buttons=None):
         if buttons:
@@ -128,7 +167,7 @@ class TelegramBot:
         else:
             return_id = self.fromFromMsg(msg)
             reply_markup = telepot.namedtuple.ForceReply()
-            self.telepotBot.sendMessage(return_id, self.serv._emojize(text), reply_markup=reply_markup)
+            self.serv._enqueueSend(self, return_id, self.telepotBot.sendMessage, return_id, self.serv._emojize(text), reply_markup=reply_markup)
 
     def sendLink(self, msg, url, buttons=None, text=""):
         # Telegram supports no special way of sending links, so just send the raw URL as text
@@ -138,12 +177,12 @@ class TelegramBot:
             text = url + "\n" + self.serv._emojize(text)
         else:
             text = url
-        self.telepotBot.sendMessage(return_id, text, reply_markup=reply_markup, disable_web_page_preview=False)
+        self.serv._enqueueSend(self, return_id, self.telepotBot.sendMessage, return_id, text, reply_markup=reply_markup, disable_web_page_preview=False)
 
     def sendPhoto(self, msg, url, buttons=None):
         return_id = self.fromFromMsg(msg)
         reply_markup = self._reply_markup(buttons)
-        self.telepotBot.sendPhoto(return_id, url, reply_markup=reply_markup)
+        self.serv._enqueueSend(self, return_id, self.telepotBot.sendPhoto, return_id, url, reply_markup=reply_markup)
 
 
 class TelegramBotWithoutFlask(TelegramBot):
@@ -152,9 +191,215 @@ class TelegramBotWithoutFlask(TelegramBot):
     See the telepot documentation for more information:
     `http://telepot.readthedocs.io/en/latest/reference.html#message-loop-and-webhook`_
     """
-    def __init__(self, serv, token):
-        self._init(serv, token)
+    def __init__(self, serv, token, answer_callback_first=False):
+        self._init(serv, token, answer_callback_first)
 
     def run(self):
         self.telepotBot.deleteWebhook()
         telepot.loop.MessageLoop(self.telepotBot, self._handle).run_as_thread()
+
+
+class TelegramBotAsync(TelegramBot):
+    """
+    asyncio variant that long-polls getUpdates() with aiohttp. No server and no telepot required.
+    Updates from different chats are handled concurrently. Handlers defined with async def run
+    in the event loop of this bot, other handlers run in the executor of the ServerHelper.
+    Bot API calls share a pool of up to :param pool_size: connections. Sends to the same chat are
+    made in order, sends to different chats are made concurrently.
+    :param api_url: is the address of the Bot API, e.g. a local fake server for testing.
+    Button clicks are acknowledged concurrently with the handler. If :param answer_callback_first:
+    is True, the callback query is answered before the clicked button is marked.
+    See `https://core.telegram.org/bots/api#getupdates`_
+    """
+    def __init__(self, serv, token, api_url="https://api.telegram.org", poll_timeout=30, poll_limit=100, pool_size=100, answer_callback_first=False):
+        self.serv = serv
+        self.answer_callback_first = answer_callback_first
+        self.token = token
+        self.api_url = "%s/bot%s/" % (api_url.rstrip("/"), token)
+        self.poll_timeout = poll_timeout
+        self.poll_limit = poll_limit
+        self.pool_size = pool_size
+        self.loop = None
+        self.session = None
+        self.__lastSend = {}
+        self.__running = None
+
+    def run(self):
+        def worker(loop):
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.runAsync())
+
+        self.loop = asyncio.new_event_loop()
+        t = Thread(target=worker, args=(self.loop, ))
+        t.daemon = True
+        t.start()
+
+    async def runAsync(self):
+        """
+        Polls for updates until stop() is called. Can be awaited in an existing event loop instead of calling run().
+        """
+        self.loop = asyncio.get_running_loop()
+        self.__running = True
+        connector = aiohttp.TCPConnector(limit=self.pool_size)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.session = session
+            await self.call("deleteWebhook")
+            offset = None
+            while self.__running:
+                try:
+                    updates = await self.call("getUpdates", offset=offset, timeout=self.poll_timeout, limit=self.poll_limit)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print("TelegramBotAsync: getUpdates failed: %s" % str(e))
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    # The whole batch is confirmed by the offset of the next getUpdates()
+                    offset = update["update_id"] + 1
+                    self.__handleUpdate(update)
+            # Wait for the last sends
+            if self.__lastSend:
+                await asyncio.wait(list(self.__lastSend.values()))
+            self.session = None
+
+    def stop(self):
+        self.__running = False
+
+    async def call(self, method, **params):
+        """
+        Calls a Bot API method and returns the result
+        """
+        params = {key: value for key, value in params.items() if value is not None}
+        timeout = aiohttp.ClientTimeout(total=self.poll_timeout + 30 if method == "getUpdates" else 60)
+        async with self.session.post(self.api_url + method, data=self.serv._jsonDumps(params), headers={"Content-Type": "application/json"}, timeout=timeout) as response:
+            result = self.serv._jsonLoads(await response.read())
+        if not result.get("ok"):
+            raise RuntimeError("%s failed: %s %s" % (method, result.get("error_code"), result.get("description")))
+        return result["result"]
+
+    def __handleUpdate(self, update):
+        # Do not wait for the handler, so the next update is processed immediately.
+        # Messages of the same user are still handled in order by the ServerHelper.
+        if "message" in update:
+            task = asyncio.ensure_future(self.__handleMessage(update["message"]))
+        elif "callback_query" in update:
+            task = asyncio.ensure_future(self.__handleCallbackQuery(update["callback_query"]))
+        else:
+            return
+        task.add_done_callback(self.__printException)
+
+    @staticmethod
+    def __printException(task):
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None:
+            traceback.print_exception(type(e), e, e.__traceback__)
+
+    async def __handleMessage(self, message):
+        message["_bot"] = self
+        message["_userId"] = self.userIdFromFrom(message["from"]["id"])
+        if "text" in message:
+            return await self.serv._handleTextMessageAsync(message)
+        elif "location" in message:
+            message["_location"] = message["location"]
+            return await self.serv._handleLocationAsync(message)
+        else:
+            print("Unkown content_type in message: %s" % str(list(message.keys())))
+
+    async def __handleCallbackQuery(self, callbackquery):
+        query_id = callbackquery["id"]
+        from_id = callbackquery["from"]["id"]
+        query_data = callbackquery.get("data", "")
+        if TelegramBot.DISABLEDBUTTON == query_data:
+            return await self.__callAll([("answerCallbackQuery", {"callback_query_id": query_id})])
+        msg = {
+            "_bot": self,
+            "_userId": self.userIdFromFrom(from_id),
+            "text": self.serv._demojize(query_data),
+            "_orgCallbackQuery": callbackquery
+        }
+        selectedButton = {"text": self.serv._emojize("%s :check_mark_button:" % query_data), "callback_data": TelegramBot.DISABLEDBUTTON}
+        calls = [
+            ("editMessageReplyMarkup", {"chat_id": from_id, "message_id": callbackquery["message"]["message_id"], "reply_markup": {"inline_keyboard": [[selectedButton]]}}),
+            ("answerCallbackQuery", {"callback_query_id": query_id})
+            ]
+        if self.answer_callback_first:
+            calls.reverse()
+        acknowledge = asyncio.ensure_future(self.__callAll(calls))
+        await self.serv._handleButtonClickAsync(msg)
+        await acknowledge
+
+    async def __callAll(self, calls):
+        """
+        Makes the Bot API calls one after another, errors are printed
+        """
+        for method, params in calls:
+            try:
+                await self.call(method, **params)
+            except Exception as e:
+                print("TelegramBotAsync: %s" % str(e))
+
+    def _renderReplyMarkup(self, buttons):
+        return {"inline_keyboard": [[{"text": text, "callback_data": data} for text, data in row] for row in self._layoutButtons(buttons)]}
+
+    def __send(self, method, **params):
+        """
+        Schedules a Bot API call in the event loop of this bot. It can be called from the
+        event loop or from any other thread. Calls to the same chat are made in order.
+        All calls share the token bucket of this bot in the outbox, see "sendRate".
+        """
+        chat_id = params["chat_id"]
+
+        def start():
+            previous = self.__lastSend.get(chat_id)
+            task = self.loop.create_task(self.__sendAfter(previous, method, params))
+            self.__lastSend[chat_id] = task
+            task.add_done_callback(lambda t: self.__lastSend.pop(chat_id) if self.__lastSend.get(chat_id) is t else None)
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            start()
+        else:
+            self.loop.call_soon_threadsafe(start)
+
+    async def __sendAfter(self, previous, method, params):
+        if previous is not None:
+            await asyncio.wait([previous])
+        bucket = self.serv.outbox.bucket(self)
+        if bucket is not None:
+            await bucket.acquireAsync()
+        try:
+            return await self.call(method, **params)
+        except Exception as e:
+            print("TelegramBotAsync: %s" % str(e))
+
+    def sendText(self, msg, text, buttons=None):
+        return_id = self.fromFromMsg(msg)
+        reply_markup = self._reply_markup(buttons)
+        self.__send("sendMessage", chat_id=return_id, text=self.serv._emojize(text), reply_markup=reply_markup)
+
+    def sendQuestion(self, msg, text, buttons=None):
+        if buttons:
+            self.sendText(msg, text, buttons)
+        else:
+            return_id = self.fromFromMsg(msg)
+            self.__send("sendMessage", chat_id=return_id, text=self.serv._emojize(text), reply_markup={"force_reply": True})
+
+    def sendLink(self, msg, url, buttons=None, text=""):
+        return_id = self.fromFromMsg(msg)
+        reply_markup = self._reply_markup(buttons)
+        if text:
+            text = url + "\n" + self.serv._emojize(text)
+        else:
+            text = url
+        self.__send("sendMessage", chat_id=return_id, text=text, reply_markup=reply_markup, disable_web_page_preview=False)
+
+    def sendPhoto(self, msg, url, buttons=None):
+        return_id = self.fromFromMsg(msg)
+        reply_markup = self._reply_markup(buttons)
+        self.__send("sendPhoto", chat_id=return_id, photo=url, reply_markup=reply_markup)
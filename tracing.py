@@ -0,0 +1,120 @@
+# builtin
+import atexit
+import collections
+import json
+import random
+import threading
+import time
+
+from . import currentTrace
+
+
+class Tracer:
+    """
+    Records the timings of the ServerHelper as spans of the trace of the message they belong to.
+    A span is a dict with the trace id, the name, the labels, the start as a unix timestamp and
+    the duration in seconds. Enable it with ServerHelper.enableTracing()
+    """
+
+    def __init__(self, sink, sampleRate=1.0):
+        """
+        :param sink: has a write(span) method
+        :param sampleRate: fraction of the messages that are traced
+        """
+        self.sink = sink
+        self.sampleRate = sampleRate
+        # perf_counter() + offset is the unix time
+        self.offset = time.time() - time.perf_counter()
+
+    def newTrace(self):
+        """
+        Returns a new trace id, or False if the message is not sampled
+        """
+        if self.sampleRate < 1.0 and random.random() >= self.sampleRate:
+            return False
+        return "%016x" % random.getrandbits(64)
+
+    @staticmethod
+    def spanName(name):
+        if name.startswith("bothelper_"):
+            name = name[10:]
+        if name.endswith("_seconds"):
+            name = name[:-8]
+        return name
+
+    def observeTiming(self, name, labels, start, end, msg=None):
+        """
+        Timing hook of the ServerHelper
+        """
+        trace = msg.get("_trace") if msg is not None else None
+        if trace is None:
+            trace = currentTrace.get()
+        if not trace:
+            return
+        self.sink.write({
+            "trace": trace,
+            "span": self.spanName(name),
+            "labels": dict(labels),
+            "start": start + self.offset,
+            "duration": end - start,
+            "thread": threading.current_thread().name
+        })
+
+
+class MemorySink:
+    """
+    Keeps the last :param maxSpans: spans in memory
+    """
+
+    def __init__(self, maxSpans=100000):
+        self.spans = collections.deque(maxlen=maxSpans)
+
+    def write(self, span):
+        self.spans.append(span)
+
+    def trace(self, trace):
+        """
+        Returns the spans of one trace ordered by their start
+        """
+        return sorted((span for span in list(self.spans) if span["trace"] == trace), key=lambda span: span["start"])
+
+    def traces(self):
+        """
+        Returns the spans by trace id
+        """
+        traces = {}
+        for span in list(self.spans):
+            traces.setdefault(span["trace"], []).append(span)
+        return traces
+
+    def clear(self):
+        self.spans.clear()
+
+
+class JsonlSink:
+    """
+    Appends the spans to the file :param path: with one JSON object per line
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__file = open(path, "a", encoding="utf-8")
+        atexit.register(self.close)
+
+    def write(self, span):
+        line = json.dumps(span, default=str) + "\n"
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.write(line)
+
+    def flush(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
@@ -0,0 +1,332 @@
+# builtin
+import io
+import os
+import atexit
+import pickle
+import sqlite3
+import threading
+
+from . import LRUCache
+
+
+class UserPickler(pickle.Pickler):
+    """
+    Pickles users but stores references to the running bot objects (the Bot, the ServerHelper,
+    the platform bots and the permanent storage) instead of copies of them.
+    """
+
+    def __init__(self, file, liveObjects):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.liveObjects = liveObjects
+
+    def persistent_id(self, obj):
+        return self.liveObjects.get(id(obj))
+
+
+class UserUnpickler(pickle.Unpickler):
+    def __init__(self, file, liveObjects):
+        super().__init__(file)
+        self.liveObjects = liveObjects
+
+    def persistent_load(self, pid):
+        if pid not in self.liveObjects:
+            raise pickle.UnpicklingError("Unknown bot object %r" % pid)
+        return self.liveObjects[pid]
+
+
+class SQLiteUserStore:
+    """
+    Stores the Bot.users in a SQLite database in WAL mode.
+    Users are loaded one by one when they write a message and only users that were
+    active since the last save are written back.
+    Use with Bot(..., userStore=SQLiteUserStore("users.sqlite"))
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.bot = None
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def attach(self, bot):
+        self.bot = bot
+
+    def __liveObjects(self):
+        """
+        Returns the live objects by their id() and by their persistent id
+        """
+        byName = {}
+        if self.bot is not None:
+            byName["bot"] = self.bot
+            byName["serv"] = self.bot.serv
+            if self.bot.userStorage is not None:
+                byName["storage"] = self.bot.userStorage
+            for i, bot in enumerate(self.bot.bots):
+                byName["%s:%d" % (type(bot).__name__, i)] = bot
+        byId = {id(obj): name for name, obj in byName.items()}
+        return byId, byName
+
+    @staticmethod
+    def key(userId):
+        return repr(userId)
+
+    def dumps(self, user):
+        buffer = io.BytesIO()
+        UserPickler(buffer, self.__liveObjects()[0]).dump(user)
+        return buffer.getvalue()
+
+    def loads(self, data):
+        return UserUnpickler(io.BytesIO(data), self.__liveObjects()[1]).load()
+
+    def load(self, userId):
+        """
+        Returns the stored User or None
+        """
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT data FROM users WHERE id = ?", (self.key(userId),)).fetchone()
+        if row is None:
+            return None
+        try:
+            return self.loads(row[0])
+        except Exception as e:
+            print("SQLiteUserStore.load(%r) failed: %s" % (userId, str(e)))
+            return None
+
+    def save(self, users):
+        """
+        Writes the users in one transaction, returns the number of written users
+        """
+        rows = []
+        for user in users:
+            try:
+                rows.append((self.key(user.userId), self.dumps(user)))
+            except Exception as e:
+                print("SQLiteUserStore.save(%r) failed: %s" % (user.userId, str(e)))
+        with self.__lock:
+            with self.__db:
+                self.__db.execute("BEGIN")
+                self.__db.executemany(
+                    "INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)", rows)
+        return len(rows)
+
+    def spill(self, user):
+        """
+        Writes a single idle user. Returns False if the user cannot be pickled,
+        e.g. because a pending button calls a lambda.
+        """
+        try:
+            data = self.dumps(user)
+        except Exception:
+            return False
+        with self.__lock:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)", (self.key(user.userId), data))
+        return True
+
+    def loadAll(self):
+        """
+        Returns a dict with all stored users
+        """
+        with self.__lock:
+            rows = self.__db.execute("SELECT data FROM users").fetchall()
+        users = {}
+        for row in rows:
+            user = self.loads(row[0])
+            users[user.userId] = user
+        return users
+
+    def delete(self, userId):
+        with self.__lock:
+            self.__db.execute(
+                "DELETE FROM users WHERE id = ?", (self.key(userId),))
+
+    def __contains__(self, userId):
+        with self.__lock:
+            return self.__db.execute(
+                "SELECT 1 FROM users WHERE id = ?", (self.key(userId),)).fetchone() is not None
+
+    def __len__(self):
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def importPickle(self, userFile):
+        """
+        One-shot migration from a userFile written by Bot.saveUserFile().
+        Returns the imported users or None if the file was already imported.
+        """
+        if userFile is None or not os.path.isfile(userFile):
+            return None
+
+        metaKey = "imported:" + os.path.abspath(userFile)
+        with self.__lock:
+            if self.__db.execute(
+                    "SELECT 1 FROM meta WHERE key = ?", (metaKey,)).fetchone() is not None:
+                return None
+
+        with open(userFile, "rb") as fs:
+            users = pickle.load(fs)
+
+        self.save(users.values())
+        with self.__lock:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (metaKey, str(len(users))))
+        print("SQLiteUserStore: Imported %d users from %s" % (len(users), userFile))
+        return users
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+
+class WriteBehindStorage:
+    """
+    Wraps a permanent storage, i.e. an object with the methods store(bot, userId, key, value),
+    retrieve(bot, userId) and clear(bot, userId).
+    Writes are collected per user and key and written in bulk every :param flushInterval: seconds,
+    when :param maxPending: values are waiting and at shutdown. If the storage has a method
+    storeMany(bot, userId, values) it is used to write all values of a user at once.
+    Users without any stored values are remembered, so retrieve() is not called again for them.
+    Failed writes of a user are retried on the next :param maxRetries: flushes and then dropped.
+    """
+
+    def __init__(self, storage, flushInterval=5.0, maxPending=1000, negativeCacheSize=100000, maxRetries=3):
+        self.storage = storage
+        self.flushInterval = flushInterval
+        self.maxPending = maxPending
+        self.maxRetries = maxRetries
+        self.__failures = {}  # (id(bot), userId) -> failed flushes in a row, only used by flush()
+        self.__pending = {}  # (id(bot), userId) -> [bot, cleared, values]
+        self.__inFlight = {}  # The entries that flush() is writing right now
+        self.__pendingValues = 0
+        self.__writes = 0
+        self.__lock = threading.Lock()
+        self.__flushLock = threading.Lock()
+        self.__empty = LRUCache(negativeCacheSize)
+        self.__wakeup = threading.Event()
+        self.__stopped = False
+
+        t = threading.Thread(target=self.__worker)
+        t.daemon = True
+        t.start()
+        atexit.register(self.close)
+
+    def __worker(self):
+        while not self.__stopped:
+            self.__wakeup.wait(self.flushInterval)
+            self.__wakeup.clear()
+            self.flush()
+
+    def __entry(self, bot, userId):
+        key = (id(bot), userId)
+        if key not in self.__pending:
+            self.__pending[key] = [bot, False, {}]
+        return self.__pending[key]
+
+    def store(self, bot, userId, key, value):
+        with self.__lock:
+            entry = self.__entry(bot, userId)
+            if key not in entry[2]:
+                self.__pendingValues += 1
+            entry[2][key] = value
+            self.__writes += 1
+            full = self.__pendingValues >= self.maxPending
+            self.__empty.pop((id(bot), userId))
+        if full:
+            self.__wakeup.set()
+
+    def clear(self, bot, userId):
+        with self.__lock:
+            entry = self.__entry(bot, userId)
+            self.__pendingValues -= len(entry[2])
+            entry[1] = True
+            entry[2] = {}
+            self.__writes += 1
+            self.__empty.put((id(bot), userId), True)
+
+    def retrieve(self, bot, userId):
+        key = (id(bot), userId)
+        with self.__lock:
+            # The values that are being written and the pending values, oldest first
+            layers = [(entry[1], dict(entry[2])) for entry in (self.__inFlight.get(key), self.__pending.get(key)) if entry is not None]
+            writes = self.__writes
+
+        values = {}
+        if not any(cleared for cleared, _ in layers) and self.__empty.get(key) is None:
+            values = self.storage.retrieve(bot, userId) or {}
+            if not values and not layers:
+                with self.__lock:
+                    # Only remember the user as empty if nothing was written in the meantime
+                    if self.__writes == writes:
+                        self.__empty.put(key, True)
+
+        for cleared, layerValues in layers:
+            if cleared:
+                values = {}
+            values.update(layerValues)
+        return values
+
+    def flush(self):
+        """
+        Writes all pending values to the storage
+        """
+        with self.__flushLock:
+            with self.__lock:
+                pending, self.__pending = self.__pending, {}
+                self.__pendingValues = 0
+                # retrieve() still sees these values until they are written
+                self.__inFlight = pending
+
+            try:
+                for key, (bot, cleared, values) in pending.items():
+                    userId = key[1]
+                    try:
+                        if cleared:
+                            self.storage.clear(bot, userId)
+                            cleared = False
+                        if values:
+                            if hasattr(self.storage, "storeMany"):
+                                self.storage.storeMany(bot, userId, values)
+                            else:
+                                for valueKey, value in values.items():
+                                    self.storage.store(bot, userId, valueKey, value)
+                    except Exception as e:
+                        failures = self.__failures.get(key, 0) + 1
+                        if failures > self.maxRetries:
+                            del self.__failures[key]
+                            print("WriteBehindStorage.flush(%r) failed %d times, dropping %d values: %s" % (
+                                userId, failures, len(values), str(e)))
+                            continue
+                        if failures == 1:
+                            print("WriteBehindStorage.flush(%r) failed, retrying: %s" % (userId, str(e)))
+                        self.__failures[key] = failures
+                        self.__requeue(bot, userId, cleared, values)
+                    else:
+                        self.__failures.pop(key, None)
+            finally:
+                with self.__lock:
+                    self.__inFlight = {}
+
+    def __requeue(self, bot, userId, cleared, values):
+        # Newer pending writes win over the failed ones
+        with self.__lock:
+            entry = self.__entry(bot, userId)
+            if entry[1]:
+                return
+            entry[1] = cleared
+            for key, value in values.items():
+                if key not in entry[2]:
+                    entry[2][key] = value
+                    self.__pendingValues += 1
+
+    def close(self):
+        self.__stopped = True
+        self.__wakeup.set()
+        self.flush()